@@ -2,42 +2,88 @@ from flask import Flask, request, jsonify, g
 from flask_cors import CORS
 import sqlite3
 import hashlib
-import bcrypt
+import hmac
 import jwt
 import datetime
 import os
-import asyncio
-import threading
-from telegram import Bot
-from telegram.error import TelegramError
+import json
+import base64
+import csv
+import io
+import time
+from telegram_service import get_telegram_service
+from jobs import get_job_manager
+from outbox import get_outbox_worker, on_job_complete
+from database import connect, get_connection, release, transaction
+from async_runtime import get_runtime
+import counters
+import idempotency
+import metrics
+import profiling
+import retention
+import scheduler
+from scheduler import cancel_schedule, create_schedule, get_scheduler, parse_schedule_time
+from counters import get_tenant_stats, get_versions
+from token_cache import TOKEN_MAX_AGE, get_token_cache
+from password_hasher import HasherBusy, get_password_hasher
+from responses import FastJSONProvider, compress_response, rows_to_dicts
+from template_engine import VARIABLES
+from media import MAX_CAPTION_LENGTH, MEDIA_TYPES, guess_media_type, store_upload
 import logging
 
 # Configuração de logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-CORS(app)  # Permitir requisições do frontend
+class BotApp(Flask):
+    """Flask cujas views async rodam no event loop compartilhado do processo
+    
+    Em vez de um loop descartável por requisição (asgiref), a corrotina é
+    agendada no runtime assíncrono, junto com o bot e a outbox. Sob o
+    servidor WSGI a thread da requisição fica presa aguardando, então as
+    views da API são síncronas; só o I/O com o Telegram (outbox) roda no loop.
+    """
+    
+    def async_to_sync(self, func):
+        def run(*args, **kwargs):
+            return get_runtime().run_in_context(profiling.profile_coroutine(func(*args, **kwargs)))
+        return run
+
+app = BotApp(__name__)
+app.json = FastJSONProvider(app)
+CORS(app, expose_headers=['X-Next-Cursor', 'ETag', 'Location', 'Retry-After', 'Idempotent-Replayed', 'X-Profile-Id'])  # Permitir requisições do frontend
 
 # Configurações
 SECRET_KEY = os.getenv('SECRET_KEY', 'sua-chave-secreta-aqui')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
 BOT_TOKEN = os.getenv('BOT_TOKEN', '')
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'admin123')
 username = os.getenv('username', 'admin')
-DATABASE_PATH = os.getenv('DATABASE_PATH', 'bot_database.db')
+# Linhas aceitas por importação
+GROUP_IMPORT_MAX_ROWS = int(os.getenv('GROUP_IMPORT_MAX_ROWS', 10000))
+# Acima disso a seleção é resolvida via tabela temporária (limite de variáveis do SQLite)
+MAX_IN_CLAUSE_IDS = 500
 
 app.config['SECRET_KEY'] = SECRET_KEY
 
-# Inicializar bot do Telegram
-bot = None
-if BOT_TOKEN:
-    bot = Bot(token=BOT_TOKEN)
+# Inicializar bot do Telegram (um único cliente HTTP compartilhado)
+bot = get_telegram_service().bot
+
+def start_background_workers():
+    """Inicia o worker da outbox, o agendador e a retenção do histórico"""
+    if bot:
+        get_outbox_worker().start()
+        get_scheduler().start()
+    retention.get_retention_worker().start()
 
 def init_database():
     """Inicializa o banco de dados SQLite"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = connect()
     cursor = conn.cursor()
     
+    # auto_vacuum incremental (espaço do histórico arquivado volta ao sistema)
+    retention.install(cursor)
+    
     # Tabela de usuários (multi-tenant)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -69,6 +115,7 @@ def init_database():
             name TEXT NOT NULL,
             content TEXT NOT NULL,
             user_id INTEGER NOT NULL,
+            version INTEGER NOT NULL DEFAULT 1,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
@@ -85,10 +132,75 @@ def init_database():
         )
     ''')
     
+    # Broadcasts e suas entregas pendentes (outbox persistente)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            message_text TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            template_id INTEGER,
+            template_version INTEGER,
+            media_id INTEGER,
+            status TEXT DEFAULT 'queued',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            group_id INTEGER,
+            chat_id TEXT NOT NULL,
+            group_name TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            telegram_message_id INTEGER,
+            claimed_at TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Resultado de cada broadcast por grupo
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_deliveries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            history_id INTEGER NOT NULL,
+            group_id INTEGER,
+            status TEXT NOT NULL,
+            telegram_message_id INTEGER,
+            error TEXT,
+            delivered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Mídias enviadas pelos usuários e o file_id do Telegram (upload único)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_cache (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            media_type TEXT NOT NULL,
+            file_name TEXT,
+            mime_type TEXT,
+            size INTEGER,
+            storage_path TEXT NOT NULL,
+            file_id TEXT,
+            file_unique_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (user_id, sha256, media_type)
+        )
+    ''')
+    
     # Criar admin padrão se não existir (email: admin@example.com)
     cursor.execute('SELECT id FROM users WHERE email = ?', ('admin@example.com',))
     if cursor.fetchone() is None:
-        password_hash = bcrypt.hashpw(ADMIN_PASSWORD.encode(), bcrypt.gensalt()).decode()
+        password_hash = get_password_hasher().hash(ADMIN_PASSWORD)
         cursor.execute('''
             INSERT INTO users (name, email, password_hash, is_admin) 
             VALUES (?, ?, ?, 1)
@@ -109,6 +221,11 @@ def init_database():
     ensure_column('groups', 'user_id', 'ALTER TABLE groups ADD COLUMN user_id INTEGER')
     ensure_column('templates', 'user_id', 'ALTER TABLE templates ADD COLUMN user_id INTEGER')
     ensure_column('message_history', 'user_id', 'ALTER TABLE message_history ADD COLUMN user_id INTEGER')
+    ensure_column('outbox', 'telegram_message_id', 'ALTER TABLE outbox ADD COLUMN telegram_message_id INTEGER')
+    ensure_column('templates', 'version', 'ALTER TABLE templates ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+    ensure_column('broadcast_jobs', 'template_id', 'ALTER TABLE broadcast_jobs ADD COLUMN template_id INTEGER')
+    ensure_column('broadcast_jobs', 'template_version', 'ALTER TABLE broadcast_jobs ADD COLUMN template_version INTEGER')
+    ensure_column('broadcast_jobs', 'media_id', 'ALTER TABLE broadcast_jobs ADD COLUMN media_id INTEGER')
 
     # Backfill user_id nulos com admin_id
     cursor.execute('UPDATE groups SET user_id = COALESCE(user_id, ?) WHERE user_id IS NULL', (admin_id,))
@@ -120,62 +237,142 @@ def init_database():
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_templates_user_id ON templates(user_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_user_id ON message_history(user_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_user_date ON message_history(user_id, sent_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_sha256 ON media_cache(sha256, media_type)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_user_status_date ON message_history(user_id, status, sent_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox(status, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_job ON outbox(job_id, status)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_deliveries_history ON message_deliveries(history_id, group_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_deliveries_group ON message_deliveries(group_id, delivered_at)')
+    
+    # Contadores por usuário para /api/stats (mantidos por triggers)
+    counters.install(cursor)
+    idempotency.install(cursor)
+    scheduler.install(cursor)
     
     conn.commit()
     conn.close()
 
 def generate_token(user):
     """Gera token JWT para autenticação"""
+    now = datetime.datetime.utcnow()
     payload = {
         'sub': user['id'],
         'email': user['email'],
         'name': user.get('name'),
         'is_admin': bool(user.get('is_admin', 0)),
-        'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
+        'iat': now,
+        'exp': now + datetime.timedelta(seconds=TOKEN_MAX_AGE)
     }
     return jwt.encode(payload, SECRET_KEY, algorithm='HS256')
 
 def verify_token(token):
-    """Verifica token JWT"""
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
-        return payload
-    except jwt.ExpiredSignatureError:
+    """Verifica token JWT (claims já verificadas vêm do cache)"""
+    cache = get_token_cache()
+    payload = cache.get(token)
+    if payload is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+        except jwt.ExpiredSignatureError:
+            return None
+        except jwt.InvalidTokenError:
+            return None
+        cache.put(token, payload)
+    if cache.is_revoked(token, payload):
         return None
-    except jwt.InvalidTokenError:
+    return payload
+
+def load_identity(user_id):
+    """Carrega do banco o registro exibido em /api/me"""
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT id, name, email, is_admin, created_at FROM users WHERE id = ?', (user_id,))
+    row = cursor.fetchone()
+    if not row:
         return None
+    return {'id': row[0], 'name': row[1], 'email': row[2], 'is_admin': bool(row[3]), 'created_at': row[4]}
+
+def authenticate():
+    """Valida o token da requisição e preenche g; retorna a resposta de erro, se houver"""
+    token = request.headers.get('Authorization')
+    if not token:
+        return jsonify({'error': 'Token não fornecido'}), 401
+    
+    if token.startswith('Bearer '):
+        token = token[7:]
+    
+    payload = verify_token(token)
+    if not payload:
+        return jsonify({'error': 'Token inválido'}), 401
+    g.user_id = payload.get('sub')
+    g.is_admin = bool(payload.get('is_admin', False))
+    g.user_email = payload.get('email')
+    return None
 
 def require_auth(f):
-    """Decorator para rotas que requerem autenticação"""
+    """Decorator para rotas que requerem autenticação (views síncronas ou async)
+    
+    O token é verificado na thread da requisição; de uma view async, só a
+    corrotina vai para o event loop.
+    """
+    view = app.ensure_sync(f)
     def decorated(*args, **kwargs):
-        token = request.headers.get('Authorization')
-        if not token:
-            return jsonify({'error': 'Token não fornecido'}), 401
-        
-        if token.startswith('Bearer '):
-            token = token[7:]
-        
-        payload = verify_token(token)
-        if not payload:
-            return jsonify({'error': 'Token inválido'}), 401
-        g.user_id = payload.get('sub')
-        g.is_admin = bool(payload.get('is_admin', False))
-        g.user_email = payload.get('email')
-        
-        return f(*args, **kwargs)
+        error = authenticate()
+        if error:
+            return error
+        return view(*args, **kwargs)
     decorated.__name__ = f.__name__
     return decorated
 
 def require_admin(f):
     """Decorator para rotas exclusivas do admin"""
+    view = app.ensure_sync(f)
     @require_auth
     def decorated(*args, **kwargs):
         if not getattr(g, 'is_admin', False):
             return jsonify({'error': 'Acesso restrito ao admin'}), 403
-        return f(*args, **kwargs)
+        return view(*args, **kwargs)
     decorated.__name__ = f.__name__
     return decorated
 
+def resource_etag(resources, user_id, versions):
+    """ETag de uma listagem: usuário, versões dos recursos e parâmetros da consulta"""
+    query = hashlib.sha1(request.query_string).hexdigest()[:12]
+    return f"{resources[0]}-{user_id}-{'.'.join(map(str, versions))}-{query}"
+
+def not_modified(etag):
+    """Resposta 304 se o cliente já tem a versão atual, senão None"""
+    if request.if_none_match.contains_weak(etag):
+        response = app.make_response(('', 304))
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return None
+
+def tag_response(response, etag):
+    """Anexa o ETag a uma resposta 200 da listagem"""
+    response = app.make_response(response)
+    if response.status_code == 200:
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def conditional(*resources):
+    """Decorator de GET condicional: 304 quando os recursos do usuário não mudaram
+    
+    As versões vêm de tenant_counters (incrementadas por triggers a cada
+    escrita), então uma revalidação custa uma busca por chave primária.
+    """
+    def decorator(f):
+        # Views async: a revalidação e a resposta ficam na thread da requisição
+        view = app.ensure_sync(f)
+        def decorated(*args, **kwargs):
+            versions = get_versions(get_connection(), g.user_id, resources)
+            etag = resource_etag(resources, g.user_id, versions)
+            return not_modified(etag) or tag_response(view(*args, **kwargs), etag)
+        decorated.__name__ = f.__name__
+        return decorated
+    return decorator
+
 # Rotas da API
 @app.route('/api/register', methods=['POST'])
 @require_admin
@@ -191,39 +388,24 @@ def register_user():
     if len(password) < 6:
         return jsonify({'error': 'A senha deve ter pelo menos 6 caracteres'}), 400
     
-    password_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    password_hash = get_password_hasher().hash(password)
     
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
     try:
-        cursor.execute('INSERT INTO users (name, email, password_hash, is_admin) VALUES (?, ?, ?, 0)', 
-                      (name, email, password_hash))
-        conn.commit()
+        with transaction() as conn:
+            conn.execute('INSERT INTO users (name, email, password_hash, is_admin) VALUES (?, ?, ?, 0)', 
+                         (name, email, password_hash))
         return jsonify({'message': 'Cliente criado com sucesso'})
     except sqlite3.IntegrityError:
         return jsonify({'error': 'Email já cadastrado'}), 400
-    finally:
-        conn.close()
 
 @app.route('/api/users', methods=['GET'])
 @require_admin
 def list_users():
     """Admin lista todos os usuários"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT id, name, email, is_admin, created_at FROM users ORDER BY created_at DESC')
-    users = cursor.fetchall()
-    conn.close()
-    users_list = [
-        {
-            'id': row[0],
-            'name': row[1],
-            'email': row[2],
-            'is_admin': bool(row[3]),
-            'created_at': row[4]
-        } for row in users
-    ]
-    return jsonify(users_list)
+    return jsonify(rows_to_dicts(cursor.fetchall(), booleans=('is_admin',)))
 
 @app.route('/api/users/<int:user_id>', methods=['DELETE'])
 @require_admin
@@ -231,14 +413,14 @@ def delete_user(user_id):
     """Admin deleta um cliente (não pode deletar a si mesmo)"""
     if user_id == getattr(g, 'user_id', None):
         return jsonify({'error': 'Admin não pode deletar a si mesmo'}), 400
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('DELETE FROM users WHERE id = ? AND is_admin = 0', (user_id,))
     conn.commit()
     if cursor.rowcount == 0:
-        conn.close()
         return jsonify({'error': 'Usuário não encontrado ou é admin'}), 404
-    conn.close()
+    # Tokens já emitidos para o usuário deixam de valer
+    get_token_cache().revoke_user(user_id)
     return jsonify({'message': 'Usuário deletado com sucesso'})
 
 
@@ -250,16 +432,18 @@ def login():
     password = data.get('password')
     if not email or not password:
         return jsonify({'error': 'Email e senha são obrigatórios'}), 400
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT id, name, email, password_hash, is_admin FROM users WHERE email = ?', (email,))
     row = cursor.fetchone()
-    conn.close()
     if not row:
         return jsonify({'error': 'Credenciais inválidas'}), 401
     stored_hash = row[3]
-    if not bcrypt.checkpw(password.encode(), stored_hash.encode() if isinstance(stored_hash, str) else stored_hash):
+    hasher = get_password_hasher()
+    if not hasher.check(password, stored_hash):
         return jsonify({'error': 'Credenciais inválidas'}), 401
+    if hasher.needs_rehash(stored_hash):
+        hasher.rehash_in_background(row[0], password)
     user = {
         'id': row[0],
         'name': row[1],
@@ -273,14 +457,10 @@ def login():
 @require_auth
 def get_me():
     """Dados do usuário logado"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name, email, is_admin, created_at FROM users WHERE id = ?', (g.user_id,))
-    row = cursor.fetchone()
-    conn.close()
-    if not row:
+    identity = get_token_cache().get_identity(g.user_id, load_identity)
+    if not identity:
         return jsonify({'error': 'Usuário não encontrado'}), 404
-    return jsonify({'id': row[0], 'name': row[1], 'email': row[2], 'is_admin': bool(row[3]), 'created_at': row[4]})
+    return jsonify(identity)
 
 @app.route('/api/me', methods=['PUT'])
 @require_auth
@@ -297,40 +477,27 @@ def update_me():
     if password:
         if len(password) < 6:
             return jsonify({'error': 'A senha deve ter pelo menos 6 caracteres'}), 400
-        password_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+        password_hash = get_password_hasher().hash(password)
         updates.append('password_hash = ?')
         params.append(password_hash)
     if not updates:
         return jsonify({'error': 'Nada para atualizar'}), 400
     params.append(g.user_id)
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(f'UPDATE users SET {", ".join(updates)} WHERE id = ?', tuple(params))
     conn.commit()
-    conn.close()
+    get_token_cache().invalidate_identity(g.user_id)
     return jsonify({'message': 'Perfil atualizado com sucesso'})
 
 @app.route('/api/groups', methods=['GET'])
 @require_auth
+@conditional('groups')
 def get_groups():
     """Lista grupos do usuário"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute('SELECT id, chat_id, name, active, created_at FROM groups WHERE user_id = ? ORDER BY name', (g.user_id,))
-    groups = cursor.fetchall()
-    conn.close()
-    
-    groups_list = []
-    for row in groups:
-        groups_list.append({
-            'id': row[0],
-            'chat_id': row[1],
-            'name': row[2],
-            'active': bool(row[3]),
-            'created_at': row[4]
-        })
-    
-    return jsonify(groups_list)
+    return jsonify(rows_to_dicts(cursor.fetchall(), booleans=('active',)))
 
 @app.route('/api/groups', methods=['POST'])
 @require_auth
@@ -343,37 +510,167 @@ def add_group():
     if not chat_id or not name:
         return jsonify({'error': 'Chat ID e nome são obrigatórios'}), 400
     
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
     try:
-        cursor.execute('INSERT INTO groups (chat_id, name, user_id) VALUES (?, ?, ?)', (chat_id, name, g.user_id))
-        conn.commit()
+        with transaction() as conn:
+            conn.execute('INSERT INTO groups (chat_id, name, user_id) VALUES (?, ?, ?)', (chat_id, name, g.user_id))
         return jsonify({'message': 'Grupo adicionado com sucesso'})
     except sqlite3.IntegrityError:
         return jsonify({'error': 'Grupo já existe'}), 400
-    finally:
-        conn.close()
+
+@app.route('/api/groups/import', methods=['POST'])
+@require_auth
+def import_groups():
+    """Importa grupos em lote (JSON ou CSV com chat_id, name, active)
+    
+    Tudo em uma transação: grupos novos são inseridos, os que já são do
+    usuário são atualizados; duplicados, inválidos e chats de outro usuário
+    são listados no resumo.
+    """
+    try:
+        rows = parse_group_import()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if len(rows) > GROUP_IMPORT_MAX_ROWS:
+        return jsonify({'error': f'Máximo de {GROUP_IMPORT_MAX_ROWS} grupos por importação'}), 413
+    
+    valid = {}
+    duplicates = []
+    invalid = []
+    for line, item in enumerate(rows, start=1):
+        group, error = validate_group_row(item)
+        if error:
+            invalid.append({'row': line, 'error': error})
+        elif group[0] in valid:
+            duplicates.append({'row': line, 'chat_id': group[0]})
+        else:
+            valid[group[0]] = (line, group)
+    
+    inserted = updated = 0
+    conflicts = []
+    with transaction(immediate=True) as conn:
+        owners = {}
+        chat_ids = list(valid)
+        for start in range(0, len(chat_ids), MAX_IN_CLAUSE_IDS):
+            chunk = chat_ids[start:start + MAX_IN_CLAUSE_IDS]
+            placeholders = ','.join('?' * len(chunk))
+            owners.update(conn.execute(
+                f'SELECT chat_id, user_id FROM groups WHERE chat_id IN ({placeholders})', chunk).fetchall())
+        
+        upserts = []
+        for chat_id, (line, (_, name, active)) in valid.items():
+            owner = owners.get(chat_id)
+            if owner is None:
+                inserted += 1
+            elif owner == g.user_id:
+                updated += 1
+            else:
+                conflicts.append({'row': line, 'chat_id': chat_id})
+                continue
+            upserts.append((chat_id, name, g.user_id, active))
+        
+        conn.executemany('''
+            INSERT INTO groups (chat_id, name, user_id, active) VALUES (?, ?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET name = excluded.name, active = excluded.active
+            WHERE groups.user_id = excluded.user_id
+        ''', upserts)
+    
+    return jsonify({
+        'total': len(rows),
+        'inserted': inserted,
+        'updated': updated,
+        'duplicates': duplicates,
+        'conflicts': conflicts,
+        'invalid': invalid
+    })
+
+def parse_group_import():
+    """Lê as linhas da importação: JSON (lista ou {"groups": [...]}) ou CSV (corpo ou arquivo)"""
+    upload = request.files.get('file')
+    if upload is not None or request.mimetype in ('text/csv', 'text/plain'):
+        raw = upload.read() if upload is not None else request.get_data()
+        try:
+            text = raw.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            raise ValueError('CSV deve estar em UTF-8')
+        lines = [line for line in csv.reader(io.StringIO(text)) if any(cell.strip() for cell in line)]
+        if lines and lines[0] and lines[0][0].strip().lower() == 'chat_id':
+            header = [cell.strip().lower() for cell in lines.pop(0)]
+        else:
+            header = ['chat_id', 'name', 'active']
+        return [dict(zip(header, line)) for line in lines]
+    
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get('groups')
+    if not isinstance(data, list):
+        raise ValueError('Envie uma lista de grupos em JSON ou um CSV (chat_id, name, active)')
+    return data
+
+def validate_group_row(item):
+    """Normaliza uma linha da importação: ((chat_id, name, active), None) ou (None, erro)"""
+    if not isinstance(item, dict):
+        return None, 'Linha deve ser um objeto com chat_id e name'
+    chat_id = str(item.get('chat_id') or '').strip()
+    name = str(item.get('name') or '').strip()
+    if not chat_id or not name:
+        return None, 'Chat ID e nome são obrigatórios'
+    
+    active = item.get('active', True)
+    if isinstance(active, str):
+        value = active.strip().lower()
+        if value in ('', '1', 'true', 'yes', 'sim', 'ativo'):
+            active = True
+        elif value in ('0', 'false', 'no', 'não', 'nao', 'inativo'):
+            active = False
+        else:
+            return None, f'Valor inválido para active: {active}'
+    elif active is None:
+        active = True
+    elif not isinstance(active, (bool, int)):
+        return None, f'Valor inválido para active: {active}'
+    return (chat_id, name, 1 if active else 0), None
+
+@app.route('/api/media', methods=['POST'])
+@require_auth
+def upload_media():
+    """Recebe uma foto, vídeo ou documento para broadcast (campo ``file``)
+    
+    O arquivo só é enviado ao Telegram no primeiro envio; depois disso o
+    file_id é reaproveitado. Use o ``id`` retornado como ``media_id`` em
+    /api/send_message.
+    """
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({'error': 'Arquivo é obrigatório'}), 400
+    media_type = request.form.get('type') or guess_media_type(upload.mimetype)
+    if media_type not in MEDIA_TYPES:
+        return jsonify({'error': f"Tipo inválido; use {', '.join(MEDIA_TYPES)}"}), 400
+    
+    try:
+        media = store_upload(upload.stream, upload.filename, upload.mimetype, media_type, g.user_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(media), 201
+
+@app.route('/api/media', methods=['GET'])
+@require_auth
+def list_media():
+    """Mídias enviadas pelo usuário"""
+    cursor = get_connection().cursor()
+    cursor.execute('''
+        SELECT id, media_type, file_name, size, file_id IS NOT NULL AS cached, created_at, last_used_at
+        FROM media_cache WHERE user_id = ? ORDER BY last_used_at DESC
+    ''', (g.user_id,))
+    return jsonify(rows_to_dicts(cursor.fetchall(), booleans=('cached',)))
 
 @app.route('/api/templates', methods=['GET'])
 @require_auth
+@conditional('templates')
 def get_templates():
     """Lista templates do usuário"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name, content, created_at FROM templates WHERE user_id = ? ORDER BY name', (g.user_id,))
-    templates = cursor.fetchall()
-    conn.close()
-    
-    templates_list = []
-    for row in templates:
-        templates_list.append({
-            'id': row[0],
-            'name': row[1],
-            'content': row[2],
-            'created_at': row[3]
-        })
-    
-    return jsonify(templates_list)
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT id, name, content, version, created_at FROM templates WHERE user_id = ? ORDER BY name', (g.user_id,))
+    return jsonify(rows_to_dicts(cursor.fetchall()))
 
 @app.route('/api/templates', methods=['POST'])
 @require_auth
@@ -386,24 +683,47 @@ def create_template():
     if not name or not content:
         return jsonify({'error': 'Nome e conteúdo são obrigatórios'}), 400
     
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('INSERT INTO templates (name, content, user_id) VALUES (?, ?, ?)', (name, content, g.user_id))
     conn.commit()
-    conn.close()
     
     return jsonify({'message': 'Template criado com sucesso'})
 
+@app.route('/api/templates/<int:template_id>', methods=['PUT'])
+@require_auth
+def update_template(template_id):
+    """Atualiza nome e/ou conteúdo de um template (nova versão)"""
+    data = request.get_json()
+    name = data.get('name')
+    content = data.get('content')
+    if not name and not content:
+        return jsonify({'error': 'Nada para atualizar'}), 400
+    
+    with transaction() as conn:
+        cursor = conn.execute('''
+            UPDATE templates SET name = COALESCE(?, name), content = COALESCE(?, content), version = version + 1
+            WHERE id = ? AND user_id = ?
+        ''', (name or None, content or None, template_id, g.user_id))
+    if cursor.rowcount == 0:
+        return jsonify({'error': 'Template não encontrado'}), 404
+    return jsonify({'message': 'Template atualizado com sucesso'})
+
+@app.route('/api/templates/variables', methods=['GET'])
+@require_auth
+def get_template_variables():
+    """Marcadores aceitos nos templates ({{nome}})"""
+    return jsonify([{'name': name, 'description': description} for name, description in VARIABLES.items()])
+
 @app.route('/api/templates/<int:template_id>', methods=['DELETE'])
 @require_auth
 def delete_template(template_id):
     """Deleta um template do usuário"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('DELETE FROM templates WHERE id = ? AND user_id = ?', (template_id, g.user_id))
     conn.commit()
     deleted = cursor.rowcount
-    conn.close()
     if deleted == 0:
         return jsonify({'error': 'Template não encontrado'}), 404
     return jsonify({'message': 'Template deletado com sucesso'})
@@ -411,13 +731,68 @@ def delete_template(template_id):
 @app.route('/api/send_message', methods=['POST'])
 @require_auth
 def send_message():
-    """Envia mensagem para grupos selecionados"""
+    """Envia mensagem para grupos selecionados
+    
+    Com o cabeçalho ``Idempotency-Key``, repetições da mesma requisição
+    devolvem a resposta original (ou o progresso do envio) sem reenviar.
+    """
     data = request.get_json()
-    message_text = data.get('message')
-    selected_groups = data.get('groups', [])
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        return broadcast_message(data)
+    if len(key) > idempotency.MAX_KEY_LENGTH:
+        return jsonify({'error': 'Idempotency-Key muito longa'}), 400
+    
+    user_id = g.user_id
+    fingerprint = idempotency.request_fingerprint(data, request.headers.get('Prefer', ''))
+    reserved, record = idempotency.reserve(user_id, key, fingerprint)
+    if not reserved:
+        return replay_idempotent(record, fingerprint)
     
-    if not message_text:
-        return jsonify({'error': 'Mensagem é obrigatória'}), 400
+    try:
+        response = app.make_response(broadcast_message(data, idempotency_key=key))
+    except BaseException:
+        idempotency.release(user_id, key)
+        raise
+    if response.status_code >= 500:
+        idempotency.release(user_id, key)
+    else:
+        idempotency.save_response(user_id, key, response.status_code, response.get_data(as_text=True))
+    return response
+
+def replay_idempotent(record, fingerprint):
+    """Resposta para uma chave já usada: original, progresso ou conflito"""
+    if record['fingerprint'] != fingerprint:
+        return jsonify({'error': 'Idempotency-Key já usada com outra requisição'}), 422
+    
+    if record['response_status'] is not None:
+        response = app.response_class(record['response_body'], status=record['response_status'],
+                                      mimetype='application/json')
+    elif record['job_id']:
+        # Envio ainda em andamento: devolve o progresso, como /api/jobs/<id>
+        response = jsonify(get_job_manager().get(record['job_id'], user_id=g.user_id, include_results=False))
+        response.status_code = 202
+        response.headers['Location'] = f"/api/jobs/{record['job_id']}"
+    else:
+        response = jsonify({'error': 'Requisição com esta Idempotency-Key em processamento'})
+        response.status_code = 409
+        response.headers['Retry-After'] = '1'
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def broadcast_message(data, idempotency_key=None):
+    """Valida a requisição e cria o broadcast na outbox
+    
+    O envio ao Telegram roda no event loop compartilhado (worker da outbox);
+    a requisição síncrona só aguarda a conclusão do job.
+    """
+    selected_groups = data.get('groups', [])
+    try:
+        content = load_broadcast_content(g.user_id, data.get('message'), data.get('template_id'), data.get('media_id'))
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     if not selected_groups:
         return jsonify({'error': 'Selecione pelo menos um grupo'}), 400
@@ -425,106 +800,470 @@ def send_message():
     if not bot:
         return jsonify({'error': 'Bot não configurado'}), 500
     
-    # Enviar mensagens
-    sent_groups = []
-    failed_groups = []
+    targets, unknown_groups = resolve_groups(g.user_id, selected_groups)
+    if not targets:
+        return jsonify({'error': 'Nenhum grupo válido selecionado', 'unknown_groups': unknown_groups}), 400
     
-    for group_id in selected_groups:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        cursor.execute('SELECT chat_id, name FROM groups WHERE id = ? AND user_id = ?', (group_id, g.user_id))
-        group = cursor.fetchone()
-        conn.close()
-        
-        if group:
-            chat_id, group_name = group
-            try:
-                # Executar envio de forma síncrona
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                loop.run_until_complete(bot.send_message(chat_id=chat_id, text=message_text))
-                loop.close()
-                
-                sent_groups.append(group_name)
-                logger.info(f"Mensagem enviada para {group_name}")
-            except Exception as e:
-                failed_groups.append(f"{group_name}: {str(e)}")
-                logger.error(f"Erro ao enviar para {group_name}: {e}")
-    
-    # Salvar no histórico
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO message_history (message_text, groups_sent, status, user_id) 
-        VALUES (?, ?, ?, ?)
-    ''', (message_text, ', '.join(sent_groups), 'sent' if sent_groups else 'failed', g.user_id))
-    conn.commit()
-    conn.close()
+    # Todo broadcast passa pela outbox, que sobrevive a restarts
+    job_manager = get_job_manager()
+    job_id = job_manager.enqueue(g.user_id, targets, **content)
+    if idempotency_key:
+        idempotency.attach_job(g.user_id, idempotency_key, job_id)
     
-    result = {
-        'sent_groups': sent_groups,
-        'failed_groups': failed_groups,
-        'total_sent': len(sent_groups),
-        'total_failed': len(failed_groups)
-    }
+    # Modo assíncrono: responde imediatamente com o id do job
+    if data.get('async') or 'respond-async' in request.headers.get('Prefer', ''):
+        response = jsonify({
+            'job_id': job_id,
+            'status': 'queued',
+            'total': len(targets),
+            'unknown_groups': unknown_groups,
+            'status_url': f'/api/jobs/{job_id}'
+        })
+        response.headers['Location'] = f'/api/jobs/{job_id}'
+        return response, 202
     
+    result = job_manager.wait(job_id)
+    result['unknown_groups'] = unknown_groups
     return jsonify(result)
 
+def load_broadcast_content(user_id, message_text, template_id=None, media_id=None):
+    """Texto, template e mídia de um broadcast, já validados (argumentos de enqueue)
+    
+    Levanta LookupError (template/mídia inexistente) ou ValueError (conteúdo inválido).
+    """
+    conn = get_connection()
+    # Sem texto, a mensagem vem do template salvo (compilado em cache por id/versão)
+    template_version = None
+    if not message_text and template_id:
+        template = conn.execute('SELECT content, version FROM templates WHERE id = ? AND user_id = ?',
+                                (template_id, user_id)).fetchone()
+        if not template:
+            raise LookupError('Template não encontrado')
+        message_text, template_version = template['content'], template['version']
+    else:
+        template_id = None
+    
+    # Com mídia, o texto é a legenda (opcional)
+    if media_id:
+        media = conn.execute('SELECT id FROM media_cache WHERE id = ? AND user_id = ?', (media_id, user_id)).fetchone()
+        if not media:
+            raise LookupError('Mídia não encontrada')
+        media_id = media['id']
+        message_text = message_text or ''
+        if len(message_text) > MAX_CAPTION_LENGTH:
+            raise ValueError(f'A legenda deve ter no máximo {MAX_CAPTION_LENGTH} caracteres')
+    elif not message_text:
+        raise ValueError('Mensagem é obrigatória')
+    
+    return {
+        'message_text': message_text,
+        'template_id': template_id,
+        'template_version': template_version,
+        'media_id': media_id or None
+    }
+
+def dispatch_scheduled(schedule):
+    """Cria o broadcast de um agendamento vencido; retorna o id do job"""
+    if not bot:
+        raise RuntimeError('Bot não configurado')
+    content = load_broadcast_content(schedule['user_id'], schedule['message_text'],
+                                     schedule['template_id'], schedule['media_id'])
+    targets, _ = resolve_groups(schedule['user_id'], schedule['group_ids'])
+    if not targets:
+        raise ValueError('Nenhum grupo válido selecionado')
+    return get_job_manager().enqueue(schedule['user_id'], targets, **content)
+
+def resolve_groups(user_id, group_ids):
+    """Resolve os grupos selecionados do usuário com uma única consulta
+    
+    Retorna (grupos encontrados na ordem pedida, ids desconhecidos ou de outro usuário).
+    """
+    requested = []
+    unknown = []
+    seen = set()
+    for group_id in group_ids:
+        try:
+            group_id = int(group_id)
+        except (TypeError, ValueError):
+            unknown.append(group_id)
+            continue
+        if group_id not in seen:
+            seen.add(group_id)
+            requested.append(group_id)
+    
+    if len(requested) <= MAX_IN_CLAUSE_IDS:
+        placeholders = ','.join('?' * len(requested))
+        rows = get_connection().execute(f'''
+            SELECT id, chat_id, name FROM groups
+            WHERE user_id = ? AND id IN ({placeholders})
+        ''', [user_id, *requested]).fetchall()
+    else:
+        # A tabela temporária vive na conexão da thread: é esvaziada a cada uso
+        with transaction() as conn:
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS selected_groups (id INTEGER PRIMARY KEY)')
+            conn.execute('DELETE FROM selected_groups')
+            conn.executemany('INSERT OR IGNORE INTO selected_groups (id) VALUES (?)', [(i,) for i in requested])
+            rows = conn.execute('''
+                SELECT gr.id, gr.chat_id, gr.name FROM selected_groups s
+                JOIN groups gr ON gr.id = s.id
+                WHERE gr.user_id = ?
+            ''', (user_id,)).fetchall()
+            conn.execute('DELETE FROM selected_groups')
+    found = {row[0]: {'id': row[0], 'chat_id': row[1], 'name': row[2]} for row in rows}
+    
+    targets = [found[group_id] for group_id in requested if group_id in found]
+    unknown.extend(group_id for group_id in requested if group_id not in found)
+    return targets, unknown
+
+def save_history(job, result):
+    """Salva um broadcast concluído no histórico
+
+    Roda na transação de ``finalize_job``: histórico, entregas e conclusão
+    do job são gravados juntos.
+    """
+    sent_groups = result['sent_groups']
+    message_text = job['message_text']
+    user_id = job['user_id']
+    with transaction() as conn:
+        if job.get('media_id'):
+            media = conn.execute('SELECT media_type, file_name FROM media_cache WHERE id = ?',
+                                 (job['media_id'],)).fetchone()
+            label = f"[{media['media_type']}: {media['file_name']}]" if media else '[mídia]'
+            message_text = f'{label} {message_text}'.strip()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO message_history (message_text, groups_sent, status, user_id) 
+            VALUES (?, ?, ?, ?)
+        ''', (message_text, ', '.join(sent_groups), 'sent' if sent_groups else 'failed', user_id))
+        # Resultado por grupo, copiado da outbox
+        cursor.execute('''
+            INSERT INTO message_deliveries (history_id, group_id, status, telegram_message_id, error, delivered_at)
+            SELECT ?, group_id, status, telegram_message_id, error, updated_at
+            FROM outbox WHERE job_id = ? ORDER BY id
+        ''', (cursor.lastrowid, job['id']))
+
+@app.route('/api/scheduled', methods=['POST'])
+@require_auth
+def create_scheduled():
+    """Agenda um broadcast (scheduled_at em ISO 8601; sem fuso = UTC)"""
+    data = request.get_json()
+    selected_groups = data.get('groups', [])
+    try:
+        scheduled_at = parse_schedule_time(data.get('scheduled_at') or '')
+    except ValueError:
+        return jsonify({'error': 'scheduled_at inválido (use ISO 8601)'}), 400
+    if scheduled_at < datetime.datetime.utcnow() - datetime.timedelta(minutes=1):
+        return jsonify({'error': 'scheduled_at deve estar no futuro'}), 400
+    
+    try:
+        content = load_broadcast_content(g.user_id, data.get('message'), data.get('template_id'), data.get('media_id'))
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not selected_groups:
+        return jsonify({'error': 'Selecione pelo menos um grupo'}), 400
+    targets, unknown_groups = resolve_groups(g.user_id, selected_groups)
+    if not targets:
+        return jsonify({'error': 'Nenhum grupo válido selecionado', 'unknown_groups': unknown_groups}), 400
+    
+    # Os grupos são resolvidos de novo no envio (podem ter sido removidos até lá)
+    schedule_id = create_schedule(g.user_id, data.get('message'), [group['id'] for group in targets], scheduled_at,
+                                  content['template_id'], content['media_id'])
+    return jsonify({
+        'id': schedule_id,
+        'status': 'pending',
+        'scheduled_at': scheduled_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'total': len(targets),
+        'unknown_groups': unknown_groups
+    }), 201
+
+@app.route('/api/scheduled', methods=['GET'])
+@require_auth
+def list_scheduled():
+    """Agendamentos do usuário (?status=pending|dispatched|failed|cancelled)"""
+    query = '''
+        SELECT id, message_text, group_ids, template_id, media_id, scheduled_at, status, job_id, error,
+               created_at, dispatched_at
+        FROM scheduled_broadcasts WHERE user_id = ?
+    '''
+    params = [g.user_id]
+    if request.args.get('status'):
+        query += ' AND status = ?'
+        params.append(request.args['status'])
+    cursor = get_connection().execute(query + ' ORDER BY scheduled_at', params)
+    schedules = rows_to_dicts(cursor.fetchall())
+    for schedule in schedules:
+        schedule['group_ids'] = json.loads(schedule['group_ids'])
+    return jsonify(schedules)
+
+@app.route('/api/scheduled/<int:schedule_id>', methods=['DELETE'])
+@require_auth
+def delete_scheduled(schedule_id):
+    """Cancela um agendamento que ainda não foi enviado"""
+    if not cancel_schedule(schedule_id, g.user_id):
+        return jsonify({'error': 'Agendamento não encontrado ou já enviado'}), 404
+    return jsonify({'message': 'Agendamento cancelado com sucesso'})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@require_auth
+def get_job(job_id):
+    """Retorna o progresso de um broadcast assíncrono"""
+    include_results = request.args.get('results', '1') != '0'
+    job = get_job_manager().get(job_id, user_id=g.user_id, include_results=include_results)
+    if not job:
+        return jsonify({'error': 'Job não encontrado'}), 404
+    return jsonify(job)
+
 @app.route('/api/history', methods=['GET'])
 @require_auth
+@conditional('history', 'groups')  # ?details=1 traz o nome atual dos grupos
 def get_history():
-    """Lista histórico de mensagens do usuário"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    """Lista histórico de mensagens do usuário (paginado por cursor)
+    
+    Parâmetros: limit (padrão 50, máx. 200), cursor (de X-Next-Cursor),
+    status, since e until (since <= sent_at < until).
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'limit inválido'}), 400
+    
+    # Keyset: as condições ficam no índice (user_id[, status], sent_at) + rowid
+    conditions = ['user_id = ?']
+    params = [g.user_id]
+    if request.args.get('status'):
+        conditions.append('status = ?')
+        params.append(request.args['status'])
+    if request.args.get('since'):
+        conditions.append('sent_at >= ?')
+        params.append(request.args['since'])
+    if request.args.get('until'):
+        conditions.append('sent_at < ?')
+        params.append(request.args['until'])
+    if request.args.get('cursor'):
+        position = decode_cursor(request.args['cursor'])
+        if position is None:
+            return jsonify({'error': 'cursor inválido'}), 400
+        conditions.append('(sent_at, id) < (?, ?)')
+        params.extend(position)
+    
+    # Os ids da página saem só do índice; as linhas completas são lidas depois, por rowid
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT id, message_text, groups_sent, sent_at, status FROM message_history WHERE user_id = ? ORDER BY sent_at DESC LIMIT 50', (g.user_id,))
+    cursor.execute(f'''
+        SELECT id, message_text, groups_sent, sent_at, status FROM message_history
+        WHERE id IN (
+            SELECT id FROM message_history
+            WHERE {' AND '.join(conditions)}
+            ORDER BY sent_at DESC, id DESC
+            LIMIT ?
+        )
+        ORDER BY sent_at DESC, id DESC
+    ''', [*params, limit + 1])
     history = cursor.fetchall()
-    conn.close()
     
-    history_list = []
-    for row in history:
-        history_list.append({
-            'id': row[0],
-            'message_text': row[1],
-            'groups_sent': row[2],
-            'sent_at': row[3],
-            'status': row[4]
-        })
+    next_cursor = None
+    if len(history) > limit:
+        history = history[:limit]
+        next_cursor = encode_cursor(history[-1][3], history[-1][0])
+    
+    history_list = rows_to_dicts(history)
     
-    return jsonify(history_list)
+    # ?details=1 inclui o resultado por grupo de cada envio (uma única consulta)
+    if request.args.get('details') == '1' and history_list:
+        by_history = {item['id']: item for item in history_list}
+        for item in history_list:
+            item['deliveries'] = []
+        conn = get_connection()
+        cursor = conn.cursor()
+        placeholders = ','.join('?' * len(by_history))
+        cursor.execute(f'''
+            SELECT d.history_id, {DELIVERY_COLUMNS}
+            FROM message_deliveries d LEFT JOIN groups gr ON gr.id = d.group_id
+            WHERE d.history_id IN ({placeholders})
+            ORDER BY d.history_id, d.id
+        ''', list(by_history))
+        for delivery in rows_to_dicts(cursor.fetchall()):
+            by_history[delivery.pop('history_id')]['deliveries'].append(delivery)
+    
+    response = jsonify(history_list)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
-@app.route('/api/stats', methods=['GET'])
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+def encode_cursor(sent_at, history_id):
+    """Gera o token opaco da próxima página a partir da última linha"""
+    raw = json.dumps([sent_at, history_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(token):
+    """Retorna (sent_at, id) do token ou None se for inválido"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        sent_at, history_id = json.loads(raw)
+        return str(sent_at), int(history_id)
+    except (ValueError, TypeError):
+        return None
+
+@app.route('/api/history/archive', methods=['GET'])
 @require_auth
-def get_stats():
-    """Retorna estatísticas do usuário"""
-    conn = sqlite3.connect(DATABASE_PATH)
+def search_history_archive():
+    """Busca no histórico arquivado (envios mais antigos que a retenção)
+    
+    Parâmetros: q (texto ou nome de grupo), status, since, until, limit e
+    cursor (de X-Next-Cursor). Lê os arquivos mensais do usuário sob demanda.
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'limit inválido'}), 400
+    before = None
+    if request.args.get('cursor'):
+        before = decode_cursor(request.args['cursor'])
+        if before is None:
+            return jsonify({'error': 'cursor inválido'}), 400
+    
+    records, more = retention.search(
+        g.user_id, query=request.args.get('q'), status=request.args.get('status'),
+        since=request.args.get('since'), until=request.args.get('until'), before=before, limit=limit)
+    response = jsonify(records)
+    if more:
+        response.headers['X-Next-Cursor'] = encode_cursor(records[-1]['sent_at'], records[-1]['id'])
+    return response
+
+# Colunas de message_deliveries (alias d, grupos gr) com os nomes usados na API
+DELIVERY_COLUMNS = '''d.group_id, gr.name AS group_name, d.status, d.telegram_message_id AS message_id,
+            d.error, d.delivered_at'''
+
+@app.route('/api/history/<int:history_id>/deliveries', methods=['GET'])
+@require_auth
+def get_history_deliveries(history_id):
+    """Resultado por grupo de um envio do histórico"""
+    status = request.args.get('status')
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM groups WHERE active = 1 AND user_id = ?', (g.user_id,))
-    active_groups = cursor.fetchone()[0]
-    cursor.execute('SELECT COUNT(*) FROM templates WHERE user_id = ?', (g.user_id,))
-    total_templates = cursor.fetchone()[0]
-    cursor.execute('''
-        SELECT COUNT(*) FROM message_history 
-        WHERE DATE(sent_at) = DATE('now') AND status = 'sent' AND user_id = ?
-    ''', (g.user_id,))
-    messages_today = cursor.fetchone()[0]
-    cursor.execute('SELECT COUNT(*) FROM message_history WHERE status = "sent" AND user_id = ?', (g.user_id,))
-    total_messages = cursor.fetchone()[0]
+    cursor.execute('SELECT id FROM message_history WHERE id = ? AND user_id = ?', (history_id, g.user_id))
+    if cursor.fetchone() is None:
+        return jsonify({'error': 'Envio não encontrado'}), 404
     
-    conn.close()
+    query = f'''
+        SELECT {DELIVERY_COLUMNS}
+        FROM message_deliveries d LEFT JOIN groups gr ON gr.id = d.group_id
+        WHERE d.history_id = ?
+    '''
+    params = [history_id]
+    if status:
+        query += ' AND d.status = ?'
+        params.append(status)
+    cursor.execute(query + ' ORDER BY d.id', params)
+    deliveries = rows_to_dicts(cursor.fetchall())
     
-    return jsonify({
-        'active_groups': active_groups,
-        'total_templates': total_templates,
-        'messages_today': messages_today,
-        'total_messages': total_messages
-    })
+    return jsonify(deliveries)
+
+@app.route('/api/stats', methods=['GET'])
+@require_auth
+def get_stats():
+    """Retorna estatísticas do usuário (contadores mantidos por triggers)"""
+    return jsonify(get_tenant_stats(get_connection(), g.user_id))
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check para monitoramento"""
     return jsonify({'status': 'ok', 'timestamp': datetime.datetime.utcnow().isoformat()})
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Métricas do processo no formato de texto do Prometheus
+    
+    Expõem rotas, consultas SQL e o backlog da outbox: exigem METRICS_TOKEN
+    ou, sem ele, só atendem conexões locais que não passaram por proxy.
+    """
+    if METRICS_TOKEN:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+            return jsonify({'error': 'Token inválido'}), 401
+    elif request.remote_addr not in ('127.0.0.1', '::1') or 'X-Forwarded-For' in request.headers:
+        return jsonify({'error': 'Defina METRICS_TOKEN para coletar métricas remotamente'}), 403
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def outbox_backlog():
+    """Entregas da outbox aguardando envio, por status (lido a cada coleta)"""
+    rows = get_connection().execute('''
+        SELECT status, COUNT(*) FROM outbox WHERE status IN ('pending', 'sending') GROUP BY status
+    ''').fetchall()
+    counts = {('pending',): 0, ('sending',): 0}
+    counts.update({(status,): count for status, count in rows})
+    return counts
+
+metrics.register_gauge('outbox_backlog', 'Entregas na outbox aguardando envio', outbox_backlog, ('status',))
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+@app.before_request
+def start_profile():
+    """Perfila a requisição se um admin pedir (X-Profile: 1) ou por amostragem"""
+    if not profiling.PROFILING_ENABLED:
+        return
+    requested = request.headers.get(profiling.PROFILE_HEADER) == '1'
+    is_admin = False
+    if requested:
+        payload = verify_token(request.headers.get('Authorization', '').removeprefix('Bearer '))
+        is_admin = bool(payload and payload.get('is_admin'))
+    reason = profiling.should_profile(requested, is_admin)
+    if reason:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        g.profile = profiling.begin(request.method, request.path, route, reason,
+                                    request.headers.get('X-Request-ID'))
+
+@app.after_request
+def finish_profile(response):
+    """Grava o perfil da requisição e devolve o seu id em X-Profile-Id"""
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profiling.end(profile, response.status_code, g.get('user_id'))
+        response.headers['X-Profile-Id'] = profile.request_id
+    return response
+
+@app.after_request
+def record_request_metrics(response):
+    """Latência por rota (o padrão da URL, não o caminho, para limitar as séries)"""
+    started = g.get('request_started')
+    if metrics.METRICS_ENABLED and started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.http_request_duration.observe(
+            time.perf_counter() - started, request.method, route, str(response.status_code))
+    return response
+
+@app.after_request
+def compress(response):
+    """Comprime respostas grandes (br/gzip) conforme o Accept-Encoding"""
+    return compress_response(response, request.accept_encodings)
+
+@app.errorhandler(HasherBusy)
+def hasher_busy(exc):
+    """Fila de hash de senhas cheia: pede ao cliente que tente novamente"""
+    response = jsonify({'error': 'Servidor ocupado, tente novamente em instantes'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+@app.teardown_request
+def release_connection(exc):
+    """Garante que nenhuma transação fique aberta entre requisições"""
+    release()
+    if g.pop('profile', None) is not None:
+        profiling.discard()
+
+# Registrar no histórico todo broadcast concluído (inclusive os retomados após restart)
+on_job_complete(save_history)
+get_scheduler().set_dispatcher(dispatch_scheduled)
+
 if __name__ == '__main__':
     init_database()
+    start_background_workers()
     port = int(os.getenv('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,134 @@
+"""
+Runtime assíncrono compartilhado pelo processo
+
+Mantém um único event loop rodando em uma thread dedicada. As rotas
+síncronas do Flask enviam corrotinas para esse loop, de forma que o cliente
+HTTP do bot (e suas conexões keep-alive) seja reaproveitado entre requisições.
+"""
+
+import asyncio
+import atexit
+import concurrent.futures
+import contextvars
+import logging
+import os
+import threading
+from typing import Any, Coroutine, Optional
+
+logger = logging.getLogger(__name__)
+
+class AsyncRuntime:
+    """Event loop de longa duração executado em uma thread de background"""
+
+    def __init__(self, name: str = 'async-runtime'):
+        self.name = name
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        """Indica se o loop está ativo neste processo"""
+        return (
+            self._thread is not None
+            and self._thread.is_alive()
+            and self._pid == os.getpid()
+        )
+
+    def start(self) -> asyncio.AbstractEventLoop:
+        """Inicia a thread do loop (idempotente e seguro após fork)"""
+        with self._lock:
+            if self.running:
+                return self.loop
+
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+
+            self._thread = threading.Thread(target=run, name=self.name, daemon=True)
+            self._thread.start()
+            ready.wait()
+            self.loop = loop
+            self._pid = os.getpid()
+            logger.info("Runtime assíncrono iniciado")
+            return loop
+
+    def submit(self, coro: Coroutine) -> concurrent.futures.Future:
+        """Agenda uma corrotina no loop compartilhado (thread-safe)"""
+        loop = self.start()
+        return asyncio.run_coroutine_threadsafe(coro, loop)
+
+    def run(self, coro: Coroutine, timeout: Optional[float] = None) -> Any:
+        """Executa uma corrotina no loop compartilhado e aguarda o resultado"""
+        if self.running and threading.current_thread() is self._thread:
+            raise RuntimeError("run() não pode ser chamado de dentro do próprio loop")
+        return self.submit(coro).result(timeout)
+
+    def run_in_context(self, coro: Coroutine, timeout: Optional[float] = None) -> Any:
+        """Como ``run``, mas a corrotina enxerga os contextvars de quem chamou
+
+        Usado pelas views async do Flask: ``request`` e ``g`` vivem em
+        contextvars da thread da requisição.
+        """
+        if self.running and threading.current_thread() is self._thread:
+            raise RuntimeError("run_in_context() não pode ser chamado de dentro do próprio loop")
+        loop = self.start()
+        context = contextvars.copy_context()
+        future = concurrent.futures.Future()
+
+        def copy_result(task: asyncio.Task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        def schedule():
+            if future.set_running_or_notify_cancel():
+                loop.create_task(coro, context=context).add_done_callback(copy_result)
+            else:
+                coro.close()
+
+        loop.call_soon_threadsafe(schedule)
+        return future.result(timeout)
+
+    def stop(self, timeout: float = 5.0):
+        """Para o loop e aguarda a thread terminar"""
+        with self._lock:
+            if not self.running:
+                return
+
+            async def cancel_tasks():
+                tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+            try:
+                asyncio.run_coroutine_threadsafe(cancel_tasks(), self.loop).result(timeout)
+            except Exception as e:
+                logger.warning(f"Tarefas pendentes ao encerrar o runtime: {e}")
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout)
+            self._thread = None
+
+# Instância global do runtime
+runtime = None
+_runtime_lock = threading.Lock()
+
+def get_runtime() -> AsyncRuntime:
+    """Retorna o runtime assíncrono do processo"""
+    global runtime
+
+    with _runtime_lock:
+        if runtime is None:
+            runtime = AsyncRuntime()
+            atexit.register(runtime.stop)
+
+    return runtime
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Benchmark de broadcasts contra o servidor falso da Bot API
+
+Uso (a partir de backend/):
+
+    python -m benchmarks.bench_broadcast --sizes 10,100,1000,10000
+    python -m benchmarks.bench_broadcast --mode api --retry-after-rate 0.01 --error-rate 0.005
+    python -m benchmarks.bench_broadcast --json atual.json --compare base.json
+
+Modos:
+  service  chama TelegramService.send_message_to_groups diretamente
+  api      percorre POST /api/send_message (outbox, worker e histórico)
+
+Relata mensagens/s, latência p50/p99 de cada chamada à Bot API e o tempo
+total. Por padrão o limitador global fica desligado para medir o próprio
+pipeline de envio; use ``--global-rate 30`` para reproduzir os limites de
+produção. Com ``--compare`` o processo termina com código 1 se a vazão de
+algum tamanho cair mais que ``--tolerance`` em relação ao arquivo base.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from benchmarks.fake_bot_api import FakeBotAPI, FakeBotConfig
+
+BENCH_TOKEN = '123456:BENCHMARK'
+
+class LatencyRecorder:
+    """Registra a duração de cada chamada à Bot API feita pelo serviço"""
+
+    def __init__(self, service):
+        self.samples: List[float] = []
+        timed = service._timed
+
+        async def recorded(method, call):
+            started = time.perf_counter()
+            try:
+                return await timed(method, call)
+            finally:
+                self.samples.append(time.perf_counter() - started)
+
+        service._timed = recorded
+
+    def reset(self):
+        self.samples = []
+
+def percentile(samples: List[float], fraction: float) -> float:
+    """Percentil por posição (amostras já medidas, sem interpolação)"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(size: int, sent: int, failed: int, wall: float, samples: List[float], server: FakeBotAPI) -> Dict:
+    return {
+        'groups': size,
+        'sent': sent,
+        'failed': failed,
+        'retry_after': server.stats['retry_after'],
+        'wall_seconds': round(wall, 3),
+        'messages_per_second': round(sent / wall, 1) if wall else 0.0,
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 2),
+    }
+
+def bench_service(sizes: List[int], server: FakeBotAPI, args) -> List[Dict]:
+    """Fan-out direto pelo TelegramService (sem banco)"""
+    from async_runtime import get_runtime
+    from rate_limiter import RateLimiter
+    from telegram_service import TelegramService
+
+    service = TelegramService(
+        BENCH_TOKEN, max_concurrency=args.concurrency, base_url=server.base_url,
+        rate_limiter=RateLimiter(global_rate=args.global_rate or 1e9))
+    recorder = LatencyRecorder(service)
+    runtime = get_runtime()
+    runtime.run(service.initialize())
+
+    results = []
+    for size in sizes:
+        groups = [{'id': i, 'chat_id': str(-100_000_000 - i), 'name': f'bench-{i}'} for i in range(size)]
+        server.reset_stats()
+        recorder.reset()
+        started = time.perf_counter()
+        outcome = runtime.run(service.send_message_to_groups(groups, args.message))
+        wall = time.perf_counter() - started
+        results.append(summarize(size, outcome['total_sent'], outcome['total_failed'],
+                                 wall, recorder.samples, server))
+    return results
+
+def bench_api(sizes: List[int], server: FakeBotAPI, args) -> List[Dict]:
+    """Broadcast completo por POST /api/send_message, em um banco temporário"""
+    os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.db')
+    os.environ['BROADCAST_CONCURRENCY'] = str(args.concurrency)
+    os.environ['TELEGRAM_GLOBAL_RATE'] = str(args.global_rate or 1e9)
+
+    import app as app_module
+    from database import transaction
+    from telegram_service import get_telegram_service
+
+    app_module.init_database()
+    recorder = LatencyRecorder(get_telegram_service())
+    client = app_module.app.test_client()
+    token = client.post('/api/login', json={
+        'email': 'admin@example.com',
+        'password': os.getenv('ADMIN_PASSWORD', 'admin123')
+    }).get_json()['token']
+    headers = {'Authorization': f'Bearer {token}'}
+    user_id = client.get('/api/me', headers=headers).get_json()['id']
+
+    results = []
+    for size in sizes:
+        with transaction() as conn:
+            conn.executemany('INSERT INTO groups (chat_id, name, user_id) VALUES (?, ?, ?)', [
+                (f'-{size}{i:06d}', f'bench-{size}-{i}', user_id) for i in range(size)])
+            group_ids = [row[0] for row in conn.execute(
+                'SELECT id FROM groups WHERE user_id = ? AND name LIKE ?', (user_id, f'bench-{size}-%'))]
+
+        server.reset_stats()
+        recorder.reset()
+        started = time.perf_counter()
+        response = client.post('/api/send_message', headers=headers,
+                               json={'message': args.message, 'groups': group_ids})
+        wall = time.perf_counter() - started
+        if response.status_code != 200:
+            raise SystemExit(f'Falha no broadcast de {size} grupos: {response.get_data(as_text=True)}')
+        outcome = response.get_json()
+        results.append(summarize(size, outcome['total_sent'], outcome['total_failed'],
+                                 wall, recorder.samples, server))
+    return results
+
+def print_table(results: List[Dict]):
+    columns = ['groups', 'sent', 'failed', 'retry_after', 'wall_seconds', 'messages_per_second', 'p50_ms', 'p99_ms']
+    print(' '.join(f'{column:>19}' for column in columns))
+    for row in results:
+        print(' '.join(f'{row[column]:>19}' for column in columns))
+
+def compare(results: List[Dict], baseline_path: str, tolerance: float) -> bool:
+    """Compara a vazão com um resultado anterior; False se houver regressão"""
+    with open(baseline_path) as f:
+        baseline = {row['groups']: row for row in json.load(f)['results']}
+
+    ok = True
+    for row in results:
+        base = baseline.get(row['groups'])
+        if not base or not base['messages_per_second']:
+            continue
+        change = row['messages_per_second'] / base['messages_per_second'] - 1
+        regression = change < -tolerance
+        ok = ok and not regression
+        print(f"{row['groups']:>7} grupos: {base['messages_per_second']} -> {row['messages_per_second']} msg/s "
+              f"({change:+.1%}){'  REGRESSÃO' if regression else ''}")
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark de broadcasts com uma Bot API falsa')
+    parser.add_argument('--mode', choices=['service', 'api'], default='service')
+    parser.add_argument('--sizes', default='10,100,1000,10000',
+                        help='Quantidades de grupos, separadas por vírgula')
+    parser.add_argument('--message', default='Mensagem de benchmark para {{group_name}}')
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('BROADCAST_CONCURRENCY', 20)),
+                        help='Envios simultâneos por broadcast')
+    parser.add_argument('--global-rate', type=float, default=0,
+                        help='Limite global em msg/s (0 desliga o limitador)')
+    parser.add_argument('--latency-ms', type=float, default=50.0)
+    parser.add_argument('--jitter-ms', type=float, default=10.0)
+    parser.add_argument('--retry-after-rate', type=float, default=0.0, help='Fração de respostas 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after (s) nas respostas 429')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fração de respostas 400')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', dest='json_path', help='Grava os resultados neste arquivo')
+    parser.add_argument('--compare', help='Resultado anterior (--json) usado como base')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='Queda de vazão aceita em relação à base (fração)')
+    args = parser.parse_args(argv)
+
+    # Sem o log por mensagem enviada, que distorceria a medição
+    logging.basicConfig(level=logging.WARNING)
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    config = FakeBotConfig(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        retry_after_rate=args.retry_after_rate, retry_after_seconds=args.retry_after,
+        error_rate=args.error_rate, seed=args.seed)
+
+    with FakeBotAPI(config) as server:
+        os.environ['BOT_TOKEN'] = BENCH_TOKEN
+        os.environ['TELEGRAM_API_URL'] = server.base_url
+        results = (bench_api if args.mode == 'api' else bench_service)(sizes, server, args)
+
+    print_table(results)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({'mode': args.mode, 'config': vars(args), 'results': results}, f, indent=2)
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+Benchmark da camada de banco com tenants sintéticos
+
+Uso (a partir de backend/):
+
+    python -m benchmarks.bench_database --history 2000000 --groups 50000 --json base.json
+    python -m benchmarks.bench_database --db /tmp/bench.db --compare base.json
+
+Gera, no schema de ``init_database``, usuários com tamanhos assimétricos
+(distribuição de Zipf: poucos tenants concentram a maior parte do histórico
+e dos grupos), grupos, templates, histórico e entregas. Em seguida mede cada
+caminho de leitura e escrita das rotas de ``app.py`` e das consultas de
+``models.py`` para o maior tenant, o mediano e o menor.
+
+Com ``--db`` o banco gerado é reaproveitado nas próximas execuções (as
+escritas medidas acrescentam poucas linhas). Com ``--compare`` o processo
+termina com código 1 se o p50 de algum caminho piorar mais que
+``--tolerance``.
+
+Os modelos legados ``Admin`` e ``Settings`` (tabelas fora do schema atual) e
+as inserções de ``models.py`` sem ``user_id`` não são medidos.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from benchmarks.bench_broadcast import BENCH_TOKEN, percentile
+from benchmarks.fake_bot_api import FakeBotAPI, FakeBotConfig
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+INSERT_CHUNK = 50000
+
+def tenant_weights(tenants: int, skew: float) -> List[float]:
+    """Participação de cada tenant (Zipf): o primeiro é o maior"""
+    weights = [1 / (rank + 1) ** skew for rank in range(tenants)]
+    total = sum(weights)
+    return [weight / total for weight in weights]
+
+def generate(conn, args, rng: random.Random) -> List[Dict]:
+    """Popula o banco; retorna os tenants (id, tamanhos) do maior para o menor"""
+    import counters
+    from password_hasher import get_password_hasher
+
+    # Carga sem os triggers de contadores; os totais são recalculados no fim
+    triggers = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND sql LIKE '%tenant_counters%'")]
+    for name in triggers:
+        conn.execute(f'DROP TRIGGER {name}')
+    conn.execute('PRAGMA synchronous = OFF')
+
+    weights = tenant_weights(args.tenants, args.skew)
+    password_hash = get_password_hasher().hash('benchmark')
+    tenants = []
+    for rank, weight in enumerate(weights):
+        cursor = conn.execute('INSERT INTO users (name, email, password_hash) VALUES (?, ?, ?)',
+                              (f'Tenant {rank}', f'tenant{rank}@bench.local', password_hash))
+        tenants.append({'rank': rank, 'id': cursor.lastrowid, 'weight': weight})
+
+    for tenant in tenants:
+        size = max(5, round(args.groups * tenant['weight']))
+        conn.executemany('INSERT INTO groups (chat_id, name, user_id, active) VALUES (?, ?, ?, ?)', [
+            (f"-100{tenant['rank']:04d}{i:07d}", f"Grupo {tenant['rank']}-{i}", tenant['id'], int(rng.random() > 0.05))
+            for i in range(size)])
+        conn.executemany('INSERT INTO templates (name, content, user_id) VALUES (?, ?, ?)', [
+            (f'Template {i}', f'Olá {{{{group_name}}}}, novidade {i} de {{{{date}}}}', tenant['id'])
+            for i in range(max(3, round(args.templates * tenant['weight'])))])
+        tenant['groups'] = size
+
+    # Histórico intercalado entre tenants, em ordem cronológica (como em produção)
+    user_ids = [tenant['id'] for tenant in tenants]
+    cumulative = []
+    total = 0.0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    start = datetime.datetime.utcnow() - datetime.timedelta(days=args.days)
+    step = args.days * 86400 / max(1, args.history)
+    written = 0
+    while written < args.history:
+        size = min(INSERT_CHUNK, args.history - written)
+        owners = rng.choices(user_ids, cum_weights=cumulative, k=size)
+        conn.executemany('''
+            INSERT INTO message_history (message_text, groups_sent, user_id, sent_at, status)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [
+            (f'Mensagem {written + i}', 'Grupo A, Grupo B', owner,
+             (start + datetime.timedelta(seconds=(written + i) * step)).strftime(TIMESTAMP_FORMAT),
+             'failed' if rng.random() < 0.05 else 'sent')
+            for i, owner in enumerate(owners)])
+        written += size
+        conn.commit()
+
+    for tenant in tenants:
+        tenant['history'] = conn.execute(
+            'SELECT COUNT(*) FROM message_history WHERE user_id = ?', (tenant['id'],)).fetchone()[0]
+        recent = [row[0] for row in conn.execute('''
+            SELECT id FROM message_history WHERE user_id = ? ORDER BY sent_at DESC, id DESC LIMIT ?
+        ''', (tenant['id'], args.deliveries))]
+        group_ids = [row[0] for row in conn.execute(
+            'SELECT id FROM groups WHERE user_id = ? LIMIT 20', (tenant['id'],))]
+        conn.executemany('''
+            INSERT INTO message_deliveries (history_id, group_id, status, telegram_message_id)
+            VALUES (?, ?, 'sent', ?)
+        ''', [(history_id, group_id, history_id) for history_id in recent for group_id in group_ids])
+
+    cursor = conn.cursor()
+    counters.install(cursor)
+    counters.rebuild(cursor)
+    conn.commit()
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('ANALYZE')
+    return tenants
+
+def load_tenants(conn) -> List[Dict]:
+    """Tenants de um banco já gerado, do maior para o menor"""
+    rows = conn.execute('''
+        SELECT u.id, COUNT(h.id) AS history,
+               (SELECT COUNT(*) FROM groups gr WHERE gr.user_id = u.id) AS groups
+        FROM users u LEFT JOIN message_history h ON h.user_id = u.id
+        WHERE u.email LIKE '%@bench.local'
+        GROUP BY u.id ORDER BY history DESC
+    ''').fetchall()
+    return [{'rank': rank, 'id': row[0], 'history': row[1], 'groups': row[2]} for rank, row in enumerate(rows)]
+
+class Case:
+    """Um caminho medido: ``run(ctx, i)`` executa a i-ésima repetição"""
+
+    def __init__(self, name: str, kind: str, run: Callable):
+        self.name = name
+        self.kind = kind
+        self.run = run
+
+def expect(response, status: int = 200):
+    if response.status_code != status:
+        raise SystemExit(f'{response.request.method} {response.request.path}: '
+                         f'{response.status_code} {response.get_data(as_text=True)[:200]}')
+    return response
+
+def api_cases() -> List[Case]:
+    """Rotas de app.py (sem If-None-Match: sempre a resposta completa)"""
+    def get(path, status=200):
+        return lambda ctx, i: expect(ctx['client'].get(path(ctx, i) if callable(path) else path,
+                                                       headers=ctx['headers']), status)
+
+    def post(path, body, status=200):
+        return lambda ctx, i: expect(ctx['client'].post(path, json=body(ctx, i), headers=ctx['headers']), status)
+
+    def history_page(ctx, i):
+        return f"/api/history?cursor={ctx['cursor']}" if ctx['cursor'] else '/api/history'
+
+    def add_template(ctx, i):
+        expect(ctx['client'].post('/api/templates', json={'name': f'Bench {i}', 'content': 'Oi {{group_name}}'},
+                                  headers=ctx['headers']))
+        ctx['template_ids'].append(ctx['conn'].execute(
+            'SELECT MAX(id) FROM templates WHERE user_id = ?', (ctx['tenant']['id'],)).fetchone()[0])
+
+    def update_template(ctx, i):
+        template_id = ctx['template_ids'][i % len(ctx['template_ids'])]
+        expect(ctx['client'].put(f'/api/templates/{template_id}', json={'content': f'Versão {i} {{{{date}}}}'},
+                                 headers=ctx['headers']))
+
+    def delete_template(ctx, i):
+        expect(ctx['client'].delete(f"/api/templates/{ctx['template_ids'].pop()}", headers=ctx['headers']))
+
+    def schedule(ctx, i):
+        when = (datetime.datetime.utcnow() + datetime.timedelta(days=30)).isoformat()
+        response = expect(ctx['client'].post('/api/scheduled', json={
+            'message': 'Agendada', 'groups': ctx['group_ids'][:10], 'scheduled_at': when}, headers=ctx['headers']), 201)
+        ctx['schedule_ids'].append(response.get_json()['id'])
+
+    def cancel_schedule(ctx, i):
+        expect(ctx['client'].delete(f"/api/scheduled/{ctx['schedule_ids'].pop()}", headers=ctx['headers']))
+
+    def send(ctx, i):
+        # Grupos diferentes a cada repetição (o limite por chat não interfere)
+        offset = (i * 10) % max(1, len(ctx['group_ids']) - 10)
+        expect(ctx['client'].post('/api/send_message', json={
+            'message': 'Benchmark {{group_name}}', 'groups': ctx['group_ids'][offset:offset + 10], 'async': True
+        }, headers=ctx['headers']), 202)
+
+    return [
+        Case('GET /api/me', 'leitura', get('/api/me')),
+        Case('GET /api/stats', 'leitura', get('/api/stats')),
+        Case('GET /api/groups', 'leitura', get('/api/groups')),
+        Case('GET /api/templates', 'leitura', get('/api/templates')),
+        Case('GET /api/history', 'leitura', get('/api/history')),
+        Case('GET /api/history (página seguinte)', 'leitura', get(history_page)),
+        Case('GET /api/history?status=failed', 'leitura', get('/api/history?status=failed')),
+        Case('GET /api/history?since=30d', 'leitura', get(lambda ctx, i: f"/api/history?since={ctx['since']}")),
+        Case('GET /api/history?details=1', 'leitura', get('/api/history?details=1&limit=20')),
+        Case('GET /api/history/<id>/deliveries', 'leitura',
+             get(lambda ctx, i: f"/api/history/{ctx['latest_history']}/deliveries")),
+        Case('GET /api/scheduled', 'leitura', get('/api/scheduled')),
+        Case('GET /api/media', 'leitura', get('/api/media')),
+        Case('POST /api/groups', 'escrita', post('/api/groups', lambda ctx, i: {
+            'chat_id': f"-900{ctx['tenant']['rank']:04d}{ctx['run']}{i:05d}", 'name': f'Novo {i}'})),
+        Case('POST /api/groups/import (100)', 'escrita', post('/api/groups/import', lambda ctx, i: {'groups': [
+            {'chat_id': f"-800{ctx['tenant']['rank']:04d}{ctx['run']}{i:04d}{j:03d}", 'name': f'Importado {j}'}
+            for j in range(100)]})),
+        Case('POST /api/templates', 'escrita', add_template),
+        Case('PUT /api/templates/<id>', 'escrita', update_template),
+        Case('DELETE /api/templates/<id>', 'escrita', delete_template),
+        Case('POST /api/scheduled', 'escrita', schedule),
+        Case('DELETE /api/scheduled/<id>', 'escrita', cancel_schedule),
+        Case('POST /api/send_message (async, 10)', 'escrita', send),
+    ]
+
+def model_cases() -> List[Case]:
+    """Consultas de models.py (sem escopo por usuário: percorrem todos os tenants)"""
+    from models import Admin, MessageHistory, Template
+
+    # Em models.py as consultas de grupos ficam na classe Admin
+    groups = Admin
+
+    def toggle(ctx, i):
+        group_id = ctx['group_ids'][i % len(ctx['group_ids'])]
+        groups.update_status(group_id, False)
+        groups.update_status(group_id, True)
+
+    return [
+        Case('models.Admin.get_active (grupos)', 'leitura', lambda ctx, i: groups.get_active()),
+        Case('models.Admin.get_by_ids (50)', 'leitura', lambda ctx, i: groups.get_by_ids(ctx['group_ids'][:50])),
+        Case('models.Template.get_all', 'leitura', lambda ctx, i: Template.get_all()),
+        Case('models.Template.get_by_id', 'leitura', lambda ctx, i: Template.get_by_id(ctx['template_ids'][0])),
+        Case('models.MessageHistory.get_recent', 'leitura', lambda ctx, i: MessageHistory.get_recent()),
+        Case('models.MessageHistory.get_stats', 'leitura', lambda ctx, i: MessageHistory.get_stats()),
+        Case('models.Admin.update_status (x2)', 'escrita', toggle),
+    ]
+
+def wait_outbox(conn, timeout: float = 120.0):
+    """Aguarda o worker esvaziar a outbox, para não concorrer com a próxima medição"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if conn.execute("SELECT COUNT(*) FROM outbox WHERE status IN ('pending', 'sending')").fetchone()[0] == 0:
+            return
+        time.sleep(0.05)
+
+def measure(cases: List[Case], ctx: Dict, iterations: int) -> List[Dict]:
+    results = []
+    for case in cases:
+        case.run(ctx, -1)  # aquecimento (cache de páginas e de statements)
+        samples = []
+        for i in range(iterations):
+            started = time.perf_counter()
+            case.run(ctx, i)
+            samples.append(time.perf_counter() - started)
+        if case.name.startswith('POST /api/send_message'):
+            wait_outbox(ctx['conn'])
+        results.append({
+            'path': case.name,
+            'kind': case.kind,
+            'tenant': ctx['label'],
+            'tenant_history': ctx['tenant']['history'],
+            'tenant_groups': ctx['tenant']['groups'],
+            'n': iterations,
+            'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+            'max_ms': round(max(samples) * 1000, 3),
+        })
+    return results
+
+def print_table(results: List[Dict]):
+    print(f"{'caminho':<40} {'tenant':<8} {'histórico':>10} {'grupos':>7} {'p50_ms':>9} {'p95_ms':>9} {'max_ms':>9}")
+    for row in results:
+        print(f"{row['path']:<40} {row['tenant']:<8} {row['tenant_history']:>10} {row['tenant_groups']:>7} "
+              f"{row['p50_ms']:>9} {row['p95_ms']:>9} {row['max_ms']:>9}")
+
+def compare(results: List[Dict], baseline_path: str, tolerance: float) -> bool:
+    """Compara o p50 com um resultado anterior; False se algum caminho piorar"""
+    with open(baseline_path) as f:
+        baseline = {(row['path'], row['tenant']): row for row in json.load(f)['results']}
+
+    ok = True
+    for row in results:
+        base = baseline.get((row['path'], row['tenant']))
+        if not base or not base['p50_ms']:
+            continue
+        change = row['p50_ms'] / base['p50_ms'] - 1
+        # Diferenças abaixo de 0,1 ms são ruído de medição
+        regression = change > tolerance and row['p50_ms'] - base['p50_ms'] > 0.1
+        ok = ok and not regression
+        if regression or abs(change) > tolerance:
+            print(f"{row['path']:<40} {row['tenant']:<8} {base['p50_ms']} -> {row['p50_ms']} ms "
+                  f"({change:+.1%}){'  REGRESSÃO' if regression else ''}")
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark das consultas com tenants sintéticos')
+    parser.add_argument('--db', help='Arquivo do banco (reaproveitado se já existir)')
+    parser.add_argument('--regenerate', action='store_true', help='Gera os dados mesmo se --db existir')
+    parser.add_argument('--tenants', type=int, default=50)
+    parser.add_argument('--skew', type=float, default=1.2, help='Expoente de Zipf dos tamanhos')
+    parser.add_argument('--history', type=int, default=2000000, help='Linhas de histórico (total)')
+    parser.add_argument('--groups', type=int, default=50000, help='Grupos (total)')
+    parser.add_argument('--templates', type=int, default=500, help='Templates (total)')
+    parser.add_argument('--deliveries', type=int, default=200,
+                        help='Envios recentes por tenant com entregas detalhadas')
+    parser.add_argument('--days', type=int, default=365, help='Período coberto pelo histórico')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', dest='json_path', help='Grava os resultados neste arquivo')
+    parser.add_argument('--compare', help='Resultado anterior (--json) usado como base')
+    parser.add_argument('--tolerance', type=float, default=0.20,
+                        help='Piora de p50 aceita em relação à base (fração)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix='bench-db-'), 'bench.db')
+    fresh = args.regenerate or not os.path.exists(path)
+    if fresh and os.path.exists(path):
+        os.remove(path)
+
+    with FakeBotAPI(FakeBotConfig(latency_ms=0, jitter_ms=0)) as server:
+        # Configuração lida na importação dos módulos do backend
+        os.environ['DATABASE_PATH'] = path
+        os.environ['BOT_TOKEN'] = BENCH_TOKEN
+        os.environ['TELEGRAM_API_URL'] = server.base_url
+        os.environ['TELEGRAM_GLOBAL_RATE'] = '1000000'
+        os.environ['TELEGRAM_CHAT_RATE_PER_MINUTE'] = '1000000'
+        os.environ['TELEGRAM_CHAT_BURST'] = '1000'
+
+        import app as app_module
+        from database import get_connection
+
+        app_module.init_database()
+        conn = get_connection()
+        if fresh:
+            started = time.perf_counter()
+            tenants = generate(conn, args, random.Random(args.seed))
+            print(f'Dados gerados em {time.perf_counter() - started:.1f}s: {path}', file=sys.stderr)
+        else:
+            tenants = load_tenants(conn)
+            print(f'Reaproveitando {path}', file=sys.stderr)
+
+        labels = {'maior': tenants[0], 'mediano': tenants[len(tenants) // 2], 'menor': tenants[-1]}
+        client = app_module.app.test_client()
+        run_id = int(time.time()) % 100000
+        since = (datetime.datetime.utcnow() - datetime.timedelta(days=30)).strftime(TIMESTAMP_FORMAT)
+
+        results = []
+        for label, tenant in labels.items():
+            user = dict(conn.execute('SELECT id, name, email, is_admin FROM users WHERE id = ?',
+                                     (tenant['id'],)).fetchone())
+            headers = {'Authorization': f'Bearer {app_module.generate_token(user)}'}
+            second_page = client.get('/api/history', headers=headers).headers.get('X-Next-Cursor')
+            ctx = {
+                'client': client, 'headers': headers, 'conn': conn, 'tenant': tenant, 'label': label,
+                'run': run_id, 'since': since, 'cursor': second_page, 'schedule_ids': [],
+                'group_ids': [row[0] for row in conn.execute(
+                    'SELECT id FROM groups WHERE user_id = ? AND active = 1 ORDER BY id', (tenant['id'],))],
+                'template_ids': [row[0] for row in conn.execute(
+                    'SELECT id FROM templates WHERE user_id = ? ORDER BY id', (tenant['id'],))],
+                'latest_history': conn.execute(
+                    'SELECT MAX(id) FROM message_history WHERE user_id = ?', (tenant['id'],)).fetchone()[0],
+            }
+            results.extend(measure(api_cases(), ctx, args.iterations))
+
+        # As consultas de models.py não dependem do tenant
+        everyone = {'rank': None, 'id': None,
+                    'history': sum(tenant['history'] for tenant in tenants),
+                    'groups': sum(tenant['groups'] for tenant in tenants)}
+        results.extend(measure(model_cases(), dict(ctx, label='todos', tenant=everyone), args.iterations))
+
+    print_table(results)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2, ensure_ascii=False)
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Servidor falso da Bot API do Telegram para benchmarks
+
+Responde a ``/bot<token>/<método>`` com o mesmo formato JSON da API real,
+simulando latência, respostas 429 (RetryAfter) e erros com taxas
+configuráveis. Roda em um event loop próprio, em uma thread separada, e
+aceita conexões keep-alive como o cliente HTTP do bot.
+"""
+
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional, Tuple
+from urllib.parse import parse_qs
+
+@dataclass
+class FakeBotConfig:
+    """Comportamento simulado da API"""
+
+    latency_ms: float = 50.0          # Latência média de cada chamada
+    jitter_ms: float = 10.0           # Variação uniforme em torno da média
+    retry_after_rate: float = 0.0     # Fração de chamadas respondidas com 429
+    retry_after_seconds: int = 1      # Valor de retry_after nas respostas 429
+    error_rate: float = 0.0           # Fração de chamadas com erro 400
+    seed: Optional[int] = None        # Semente para resultados reproduzíveis
+
+class FakeBotAPI:
+    """Servidor HTTP mínimo que imita a Bot API"""
+
+    def __init__(self, config: FakeBotConfig = None, host: str = '127.0.0.1', port: int = 0):
+        self.config = config or FakeBotConfig()
+        self.host = host
+        self.port = port
+        self.stats = Counter()
+        self._random = random.Random(self.config.seed)
+        self._message_ids = itertools.count(1)
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._connections = {}
+
+    @property
+    def base_url(self) -> str:
+        """Valor para ``Bot(base_url=...)`` / TELEGRAM_API_URL"""
+        return f'http://{self.host}:{self.port}/bot'
+
+    def start(self) -> 'FakeBotAPI':
+        """Sobe o servidor em uma thread própria e aguarda a porta ficar disponível"""
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port, backlog=1024))
+            self.port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='fake-bot-api', daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        """Encerra o servidor"""
+        if self._loop is None:
+            return
+
+        async def shutdown():
+            self._server.close()
+            # Conexões keep-alive ainda abertas não são encerradas pelo close()
+            for writer in self._connections.values():
+                writer.close()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset_stats(self):
+        self.stats.clear()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                request_line, *header_lines = head.decode('latin-1').split('\r\n')
+                headers = {}
+                for line in header_lines:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0) or 0))
+
+                path = request_line.split(' ')[1]
+                method = path.rstrip('/').rsplit('/', 1)[-1]
+                status, payload = await self._respond(method, headers.get('content-type', ''), body)
+
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                    f'Content-Type: application/json\r\n'
+                    f'Content-Length: {len(data)}\r\n'
+                    f'Connection: keep-alive\r\n\r\n'.encode() + data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+
+    async def _respond(self, method: str, content_type: str, body: bytes) -> Tuple[int, dict]:
+        config = self.config
+        self.stats['requests'] += 1
+        self.stats[f'method:{method}'] += 1
+
+        delay = config.latency_ms + self._random.uniform(-config.jitter_ms, config.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {
+                'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot',
+                'can_join_groups': True, 'can_read_all_group_messages': False,
+                'supports_inline_queries': False}}
+
+        roll = self._random.random()
+        if roll < config.retry_after_rate:
+            self.stats['retry_after'] += 1
+            return 429, {'ok': False, 'error_code': 429,
+                         'description': f'Too Many Requests: retry after {config.retry_after_seconds}',
+                         'parameters': {'retry_after': config.retry_after_seconds}}
+        if roll < config.retry_after_rate + config.error_rate:
+            self.stats['errors'] += 1
+            return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: chat not found'}
+
+        self.stats['sent'] += 1
+        return 200, {'ok': True, 'result': {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': _chat_id(content_type, body), 'type': 'supergroup', 'title': 'Benchmark'},
+            'text': 'ok'}}
+
+def _chat_id(content_type: str, body: bytes) -> int:
+    """chat_id da requisição (apenas para compor a resposta)"""
+    try:
+        if 'json' in content_type:
+            value = json.loads(body).get('chat_id')
+        elif 'urlencoded' in content_type:
+            value = parse_qs(body.decode()).get('chat_id', [None])[0]
+        else:
+            value = None
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
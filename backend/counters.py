@@ -0,0 +1,229 @@
+"""
+Contadores pré-calculados por usuário (tenant)
+
+Triggers do SQLite mantêm ``tenant_counters`` e ``tenant_daily_counters`` na
+mesma transação das escritas em groups, templates e message_history, de modo
+que /api/stats é uma leitura por chave primária, independente do volume do
+histórico.
+
+As mesmas linhas guardam uma versão por recurso (grupos, templates e
+histórico), incrementada a cada escrita; ela é a base dos ETags das listagens.
+"""
+
+import sqlite3
+from typing import Dict
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS tenant_counters (
+        user_id INTEGER PRIMARY KEY,
+        active_groups INTEGER NOT NULL DEFAULT 0,
+        total_templates INTEGER NOT NULL DEFAULT 0,
+        total_messages INTEGER NOT NULL DEFAULT 0,
+        groups_version INTEGER NOT NULL DEFAULT 0,
+        templates_version INTEGER NOT NULL DEFAULT 0,
+        history_version INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS tenant_daily_counters (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        messages_sent INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day)
+    ) WITHOUT ROWID
+    ''',
+]
+
+# Os contadores de mensagens são acumulados: remover linhas antigas do
+# histórico (arquivamento) não altera os totais, por isso não há trigger de DELETE.
+TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_groups_counters_insert AFTER INSERT ON groups
+    BEGIN
+        INSERT INTO tenant_counters (user_id, active_groups)
+        SELECT NEW.user_id, COALESCE(NEW.active = 1, 0) WHERE NEW.user_id IS NOT NULL
+        ON CONFLICT(user_id) DO UPDATE SET active_groups = active_groups + excluded.active_groups;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_groups_counters_delete AFTER DELETE ON groups
+    BEGIN
+        UPDATE tenant_counters SET active_groups = active_groups - COALESCE(OLD.active = 1, 0)
+        WHERE user_id = OLD.user_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_groups_counters_update AFTER UPDATE OF active, user_id ON groups
+    BEGIN
+        UPDATE tenant_counters SET active_groups = active_groups - COALESCE(OLD.active = 1, 0)
+        WHERE user_id = OLD.user_id;
+        INSERT INTO tenant_counters (user_id, active_groups)
+        SELECT NEW.user_id, COALESCE(NEW.active = 1, 0) WHERE NEW.user_id IS NOT NULL
+        ON CONFLICT(user_id) DO UPDATE SET active_groups = active_groups + excluded.active_groups;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_templates_counters_insert AFTER INSERT ON templates
+    BEGIN
+        INSERT INTO tenant_counters (user_id, total_templates)
+        SELECT NEW.user_id, 1 WHERE NEW.user_id IS NOT NULL
+        ON CONFLICT(user_id) DO UPDATE SET total_templates = total_templates + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_templates_counters_delete AFTER DELETE ON templates
+    BEGIN
+        UPDATE tenant_counters SET total_templates = total_templates - 1
+        WHERE user_id = OLD.user_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_templates_counters_update AFTER UPDATE OF user_id ON templates
+    BEGIN
+        UPDATE tenant_counters SET total_templates = total_templates - 1
+        WHERE user_id = OLD.user_id;
+        INSERT INTO tenant_counters (user_id, total_templates)
+        SELECT NEW.user_id, 1 WHERE NEW.user_id IS NOT NULL
+        ON CONFLICT(user_id) DO UPDATE SET total_templates = total_templates + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_history_counters_insert AFTER INSERT ON message_history
+    WHEN NEW.status = 'sent'
+    BEGIN
+        INSERT INTO tenant_counters (user_id, total_messages)
+        SELECT NEW.user_id, 1 WHERE NEW.user_id IS NOT NULL
+        ON CONFLICT(user_id) DO UPDATE SET total_messages = total_messages + 1;
+        INSERT INTO tenant_daily_counters (user_id, day, messages_sent)
+        SELECT NEW.user_id, DATE(NEW.sent_at), 1 WHERE NEW.user_id IS NOT NULL
+        ON CONFLICT(user_id, day) DO UPDATE SET messages_sent = messages_sent + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_history_counters_unsend AFTER UPDATE OF status, user_id, sent_at ON message_history
+    WHEN OLD.status = 'sent'
+    BEGIN
+        UPDATE tenant_counters SET total_messages = total_messages - 1
+        WHERE user_id = OLD.user_id;
+        UPDATE tenant_daily_counters SET messages_sent = messages_sent - 1
+        WHERE user_id = OLD.user_id AND day = DATE(OLD.sent_at);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_history_counters_send AFTER UPDATE OF status, user_id, sent_at ON message_history
+    WHEN NEW.status = 'sent'
+    BEGIN
+        INSERT INTO tenant_counters (user_id, total_messages)
+        SELECT NEW.user_id, 1 WHERE NEW.user_id IS NOT NULL
+        ON CONFLICT(user_id) DO UPDATE SET total_messages = total_messages + 1;
+        INSERT INTO tenant_daily_counters (user_id, day, messages_sent)
+        SELECT NEW.user_id, DATE(NEW.sent_at), 1 WHERE NEW.user_id IS NOT NULL
+        ON CONFLICT(user_id, day) DO UPDATE SET messages_sent = messages_sent + 1;
+    END
+    ''',
+]
+
+# Recursos versionados: nome -> tabela de origem
+VERSIONED = {
+    'groups': 'groups',
+    'templates': 'templates',
+    'history': 'message_history',
+}
+
+def _version_triggers(resource: str, table: str):
+    bump = f'''
+        INSERT INTO tenant_counters (user_id, {resource}_version)
+        SELECT {{row}}.user_id, 1 WHERE {{row}}.user_id IS NOT NULL
+        ON CONFLICT(user_id) DO UPDATE SET {resource}_version = {resource}_version + 1;
+    '''
+    return [
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_version_insert AFTER INSERT ON {table}
+        BEGIN {bump.format(row='NEW')} END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_version_delete AFTER DELETE ON {table}
+        BEGIN {bump.format(row='OLD')} END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_version_update AFTER UPDATE ON {table}
+        BEGIN {bump.format(row='OLD')} {bump.format(row='NEW')} END
+        ''',
+    ]
+
+VERSION_TRIGGERS = [
+    statement
+    for resource, table in VERSIONED.items()
+    for statement in _version_triggers(resource, table)
+]
+
+def install(cursor: sqlite3.Cursor):
+    """Cria tabelas e triggers; recalcula os contadores na primeira instalação"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tenant_counters'")
+    first_install = cursor.fetchone() is None
+
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+    # Bancos criados antes das versões por recurso
+    cursor.execute('PRAGMA table_info(tenant_counters)')
+    columns = {row[1] for row in cursor.fetchall()}
+    for resource in VERSIONED:
+        if f'{resource}_version' not in columns:
+            cursor.execute(f'ALTER TABLE tenant_counters ADD COLUMN {resource}_version INTEGER NOT NULL DEFAULT 0')
+
+    for statement in TRIGGERS + VERSION_TRIGGERS:
+        cursor.execute(statement)
+
+    if first_install:
+        rebuild(cursor)
+
+def rebuild(cursor: sqlite3.Cursor):
+    """Recalcula todos os contadores a partir das tabelas de origem"""
+    cursor.execute('DELETE FROM tenant_counters')
+    cursor.execute('DELETE FROM tenant_daily_counters')
+    cursor.execute('''
+        INSERT INTO tenant_counters (user_id, active_groups, total_templates, total_messages)
+        SELECT user_id, SUM(active_groups), SUM(total_templates), SUM(total_messages) FROM (
+            SELECT user_id, COUNT(*) AS active_groups, 0 AS total_templates, 0 AS total_messages
+            FROM groups WHERE active = 1 GROUP BY user_id
+            UNION ALL
+            SELECT user_id, 0, COUNT(*), 0 FROM templates GROUP BY user_id
+            UNION ALL
+            SELECT user_id, 0, 0, COUNT(*) FROM message_history WHERE status = 'sent' GROUP BY user_id
+        ) WHERE user_id IS NOT NULL
+        GROUP BY user_id
+    ''')
+    cursor.execute('''
+        INSERT INTO tenant_daily_counters (user_id, day, messages_sent)
+        SELECT user_id, DATE(sent_at), COUNT(*) FROM message_history
+        WHERE status = 'sent' AND user_id IS NOT NULL
+        GROUP BY user_id, DATE(sent_at)
+    ''')
+
+def get_versions(conn: sqlite3.Connection, user_id: int, resources) -> tuple:
+    """Versões atuais dos recursos do usuário (mudam a cada escrita)"""
+    unknown = [resource for resource in resources if resource not in VERSIONED]
+    if unknown:
+        raise ValueError(f"Recurso sem versão: {', '.join(unknown)}")
+    columns = ', '.join(f'{resource}_version' for resource in resources)
+    row = conn.execute(f'SELECT {columns} FROM tenant_counters WHERE user_id = ?', (user_id,)).fetchone()
+    return tuple(row) if row else (0,) * len(resources)
+
+def get_tenant_stats(conn: sqlite3.Connection, user_id: int) -> Dict:
+    """Estatísticas do usuário lidas dos contadores (duas buscas por chave)"""
+    row = conn.execute('''
+        SELECT active_groups, total_templates, total_messages
+        FROM tenant_counters WHERE user_id = ?
+    ''', (user_id,)).fetchone()
+    today = conn.execute('''
+        SELECT messages_sent FROM tenant_daily_counters
+        WHERE user_id = ? AND day = DATE('now')
+    ''', (user_id,)).fetchone()
+    return {
+        'active_groups': row[0] if row else 0,
+        'total_templates': row[1] if row else 0,
+        'messages_today': today[0] if today else 0,
+        'total_messages': row[2] if row else 0
+    }
@@ -0,0 +1,174 @@
+"""
+Camada de conexão com o SQLite
+
+Cada thread mantém uma conexão própria, reaproveitada entre requisições, em
+modo WAL: leituras não bloqueiam a escrita do histórico durante broadcasts.
+
+Código assíncrono usa ``run_async``/``fetchone``/``fetchall``/``execute``,
+que executam as consultas em um pool pequeno de threads com conexões
+próprias, sem bloquear o event loop.
+"""
+
+import asyncio
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, List, Optional, Sequence
+
+import metrics
+import profiling
+
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'bot_database.db')
+
+# Tempo que uma escrita espera pelo lock antes de "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 30000))
+# Statements preparados mantidos em cache por conexão
+SQLITE_STATEMENT_CACHE = int(os.getenv('SQLITE_STATEMENT_CACHE', 256))
+# Threads (e conexões) dedicadas às consultas feitas por código assíncrono
+SQLITE_ASYNC_WORKERS = int(os.getenv('SQLITE_ASYNC_WORKERS', 4))
+
+_local = threading.local()
+
+def _observe(sql: str, elapsed: float):
+    if metrics.METRICS_ENABLED:
+        metrics.observe_query(sql, elapsed)
+    profiling.record_query(sql, elapsed)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor que registra o tempo de cada consulta (métricas e perfil da requisição)"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _observe(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _observe(sql, time.perf_counter() - started)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Conexão cujos cursores (inclusive os de conn.execute) são instrumentados"""
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or InstrumentedCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+_async_executor = None
+_async_executor_pid = None
+_async_executor_lock = threading.Lock()
+
+def connect(path: str = None) -> sqlite3.Connection:
+    """Abre uma nova conexão já configurada (WAL, busy_timeout, synchronous)"""
+    conn = sqlite3.connect(
+        path or DATABASE_PATH,
+        timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=SQLITE_STATEMENT_CACHE,
+        factory=InstrumentedConnection if metrics.METRICS_ENABLED or profiling.PROFILING_ENABLED else sqlite3.Connection
+    )
+    conn.row_factory = sqlite3.Row  # Acesso por índice ou pelo nome da coluna
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}')
+    # Em WAL, NORMAL é seguro contra corrupção e evita um fsync por commit
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+def get_connection() -> sqlite3.Connection:
+    """Retorna a conexão da thread atual, abrindo-a se necessário"""
+    conn = getattr(_local, 'conn', None)
+    # Conexões não podem atravessar um fork (workers do gunicorn)
+    if conn is None or _local.pid != os.getpid():
+        conn = connect()
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+@contextmanager
+def transaction(immediate: bool = False):
+    """Executa um bloco em uma transação: commit ao final, rollback em erro
+
+    ``immediate`` reserva o lock de escrita já no início (para ler-e-atualizar).
+    Blocos aninhados participam da transação externa: o BEGIN é explícito,
+    senão o sqlite3 só abriria a transação no primeiro INSERT/UPDATE/DELETE
+    e um bloco interno faria commit sozinho.
+    """
+    conn = get_connection()
+    if conn.in_transaction:
+        yield conn
+        return
+
+    conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+def release():
+    """Desfaz uma transação deixada aberta (chamado ao fim de cada requisição)"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid() and conn.in_transaction:
+        conn.rollback()
+
+def close():
+    """Fecha a conexão da thread atual"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _local.conn = None
+        conn.close()
+
+def _executor() -> ThreadPoolExecutor:
+    global _async_executor, _async_executor_pid
+
+    with _async_executor_lock:
+        if _async_executor is None or _async_executor_pid != os.getpid():
+            _async_executor = ThreadPoolExecutor(max_workers=max(1, SQLITE_ASYNC_WORKERS),
+                                                 thread_name_prefix='sqlite')
+            _async_executor_pid = os.getpid()
+        return _async_executor
+
+async def run_async(fn: Callable, *args, **kwargs) -> Any:
+    """Executa ``fn(*args, **kwargs)`` no pool do banco; ``fn`` usa get_connection()/transaction()"""
+    def call():
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            release()
+    # Leva o contexto (ex.: o perfil da requisição) para a thread do pool
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_executor(), context.run, call)
+
+def _fetch(sql: str, params: Sequence, one: bool):
+    cursor = get_connection().execute(sql, params)
+    return cursor.fetchone() if one else cursor.fetchall()
+
+def _execute(sql: str, params: Sequence) -> int:
+    with transaction() as conn:
+        return conn.execute(sql, params).rowcount
+
+async def fetchone(sql: str, params: Sequence = ()) -> Optional[sqlite3.Row]:
+    """Primeira linha da consulta, sem bloquear o event loop"""
+    return await run_async(_fetch, sql, params, True)
+
+async def fetchall(sql: str, params: Sequence = ()) -> List[sqlite3.Row]:
+    """Todas as linhas da consulta, sem bloquear o event loop"""
+    return await run_async(_fetch, sql, params, False)
+
+async def execute(sql: str, params: Sequence = ()) -> int:
+    """Executa uma escrita em transação própria; retorna as linhas afetadas"""
+    return await run_async(_execute, sql, params)
@@ -0,0 +1,13 @@
+"""
+Hooks do gunicorn (carregado automaticamente a partir do diretório backend)
+"""
+
+def on_starting(server):
+    """Cria/migra o banco uma única vez, no processo master"""
+    from app import init_database
+    init_database()
+
+def post_worker_init(worker):
+    """Cada worker retoma os broadcasts pendentes da outbox"""
+    from app import start_background_workers
+    start_background_workers()
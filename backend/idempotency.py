@@ -0,0 +1,94 @@
+"""
+Chaves de idempotência para /api/send_message
+
+Um retry (cliente ou proxy) com o mesmo cabeçalho ``Idempotency-Key`` não
+dispara um novo broadcast: recebe a resposta original ou, se o envio ainda
+estiver em andamento, o progresso do job. As chaves expiram após um TTL.
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, Optional, Tuple
+
+from database import transaction
+
+# Validade de uma chave (horas)
+IDEMPOTENCY_TTL_HOURS = float(os.getenv('IDEMPOTENCY_TTL_HOURS', 24))
+# Reserva sem job após esse tempo é considerada abandonada (processo caiu)
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv('IDEMPOTENCY_LOCK_SECONDS', 60))
+
+MAX_KEY_LENGTH = 255
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        user_id INTEGER NOT NULL,
+        idempotency_key TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        job_id TEXT,
+        response_status INTEGER,
+        response_body TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        expires_at TIMESTAMP NOT NULL,
+        PRIMARY KEY (user_id, idempotency_key)
+    ) WITHOUT ROWID
+'''
+
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency_keys(expires_at)',
+]
+
+def install(cursor):
+    """Cria a tabela de chaves e seus índices"""
+    cursor.execute(SCHEMA)
+    for statement in INDEXES:
+        cursor.execute(statement)
+
+def request_fingerprint(*parts) -> str:
+    """Hash do corpo da requisição: a mesma chave não pode ser usada para outro envio"""
+    raw = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def reserve(user_id: int, key: str, fingerprint: str) -> Tuple[bool, Optional[Dict]]:
+    """Reserva a chave para esta requisição
+
+    Retorna (True, None) se a requisição deve ser processada ou (False, registro)
+    se a chave já existe.
+    """
+    ttl = f'+{IDEMPOTENCY_TTL_HOURS * 3600:.0f} seconds'
+    lock = f'-{IDEMPOTENCY_LOCK_SECONDS} seconds'
+    with transaction(immediate=True) as conn:
+        conn.execute("DELETE FROM idempotency_keys WHERE expires_at < datetime('now')")
+        row = conn.execute('''
+            SELECT fingerprint, job_id, response_status, response_body,
+                   job_id IS NULL AND response_status IS NULL AND created_at < datetime('now', ?) AS abandoned
+            FROM idempotency_keys WHERE user_id = ? AND idempotency_key = ?
+        ''', (lock, user_id, key)).fetchone()
+        if row is not None and not row['abandoned']:
+            return False, dict(row)
+
+        conn.execute('''
+            INSERT OR REPLACE INTO idempotency_keys (user_id, idempotency_key, fingerprint, expires_at)
+            VALUES (?, ?, ?, datetime('now', ?))
+        ''', (user_id, key, fingerprint, ttl))
+    return True, None
+
+def attach_job(user_id: int, key: str, job_id: str):
+    """Associa o broadcast criado à chave (retries passam a ver o progresso)"""
+    with transaction() as conn:
+        conn.execute('UPDATE idempotency_keys SET job_id = ? WHERE user_id = ? AND idempotency_key = ?',
+                     (job_id, user_id, key))
+
+def save_response(user_id: int, key: str, status: int, body: str):
+    """Guarda a resposta final, devolvida como está aos próximos retries"""
+    with transaction() as conn:
+        conn.execute('''
+            UPDATE idempotency_keys SET response_status = ?, response_body = ?
+            WHERE user_id = ? AND idempotency_key = ?
+        ''', (status, body, user_id, key))
+
+def release(user_id: int, key: str):
+    """Libera a chave de uma requisição que falhou antes de criar o broadcast"""
+    with transaction() as conn:
+        conn.execute('DELETE FROM idempotency_keys WHERE user_id = ? AND idempotency_key = ? AND job_id IS NULL',
+                     (user_id, key))
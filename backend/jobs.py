@@ -0,0 +1,170 @@
+"""
+Jobs de broadcast executados em background
+
+Cada job é gravado em ``broadcast_jobs`` e suas entregas na ``outbox``; o
+envio é feito pelo worker da outbox, então o progresso sobrevive a restarts
+e pode ser consultado por qualquer processo.
+"""
+
+import asyncio
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from database import get_connection, run_async, transaction
+from outbox import after_job_complete, finalize_job, get_outbox_worker, job_result
+
+class JobManager:
+    """Cria broadcasts na outbox e consulta seu progresso"""
+
+    def __init__(self):
+        self._waiters: Dict[str, threading.Event] = {}
+        self._async_waiters: Dict[str, Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = {}
+        self._lock = threading.Lock()
+        after_job_complete(self._notify)
+
+    def enqueue(self, user_id: int, groups: List[Dict], message_text: str,
+                template_id: Optional[int] = None, template_version: Optional[int] = None,
+                media_id: Optional[int] = None) -> str:
+        """Grava o job e suas entregas em uma única transação; retorna o id
+
+        ``message_text`` pode conter marcadores (``{{group_name}}``...), que
+        são resolvidos por grupo no envio; com ``media_id`` ele é a legenda.
+        """
+        job_id = uuid.uuid4().hex
+        with transaction() as conn:
+            conn.execute('''
+                INSERT INTO broadcast_jobs (id, user_id, message_text, total, template_id, template_version, media_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (job_id, user_id, message_text, len(groups), template_id, template_version, media_id))
+            conn.executemany('''
+                INSERT INTO outbox (job_id, user_id, group_id, chat_id, group_name)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(job_id, user_id, group['id'], group['chat_id'], group['name']) for group in groups])
+
+        if not groups:
+            finalize_job(job_id)
+        else:
+            worker = get_outbox_worker()
+            worker.start()
+            worker.wake()
+        return job_id
+
+    def wait(self, job_id: str, timeout: Optional[float] = None, poll_interval: float = 1.0) -> Optional[Dict]:
+        """Bloqueia até o job terminar e retorna o resultado (None em timeout)
+
+        O job pode ser concluído por outro processo, por isso o banco também
+        é consultado periodicamente.
+        """
+        event = threading.Event()
+        with self._lock:
+            self._waiters[job_id] = event
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        try:
+            while not event.is_set() and self._status(job_id) != 'completed':
+                wait_for = poll_interval
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    wait_for = min(wait_for, remaining)
+                event.wait(wait_for)
+        finally:
+            with self._lock:
+                self._waiters.pop(job_id, None)
+
+        return job_result(get_connection(), job_id)
+
+    async def wait_async(self, job_id: str, timeout: Optional[float] = None,
+                         poll_interval: float = 1.0) -> Optional[Dict]:
+        """Versão assíncrona de ``wait``: aguarda sem ocupar uma thread"""
+        event = asyncio.Event()
+        with self._lock:
+            self._async_waiters[job_id] = (asyncio.get_running_loop(), event)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        try:
+            while not event.is_set() and await run_async(self._status, job_id) != 'completed':
+                wait_for = poll_interval
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    wait_for = min(wait_for, remaining)
+                try:
+                    await asyncio.wait_for(event.wait(), wait_for)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._lock:
+                self._async_waiters.pop(job_id, None)
+
+        return await run_async(lambda: job_result(get_connection(), job_id))
+
+    def get(self, job_id: str, user_id: Optional[int] = None, include_results: bool = True) -> Optional[Dict]:
+        """Retorna o progresso de um job, opcionalmente restrito ao dono"""
+        conn = get_connection()
+        job = conn.execute('''
+            SELECT id, user_id, status, total, created_at, started_at, finished_at,
+                   (julianday('now') - julianday(started_at)) * 86400 AS elapsed
+            FROM broadcast_jobs WHERE id = ?
+        ''', (job_id,)).fetchone()
+        if job is None or (user_id is not None and job['user_id'] != user_id):
+            return None
+
+        counts = dict(conn.execute('''
+            SELECT status, COUNT(*) FROM outbox WHERE job_id = ? GROUP BY status
+        ''', (job_id,)).fetchall())
+        sent = counts.get('sent', 0)
+        failed = counts.get('failed', 0)
+        done = sent + failed
+        total = job['total']
+
+        eta_seconds = None
+        if job['status'] == 'running' and done and job['elapsed'] is not None:
+            eta_seconds = round(job['elapsed'] / done * (total - done), 1)
+
+        data = {
+            'job_id': job['id'],
+            'status': job['status'],
+            'total': total,
+            'sent': sent,
+            'failed': failed,
+            'pending': total - done,
+            'progress': round(done / total * 100, 1) if total else 100.0,
+            'eta_seconds': eta_seconds,
+            'created_at': job['created_at'],
+            'started_at': job['started_at'],
+            'finished_at': job['finished_at']
+        }
+        if include_results:
+            data['results'] = [dict(row) for row in conn.execute('''
+                SELECT group_id, group_name AS name, status, error
+                FROM outbox WHERE job_id = ? ORDER BY id
+            ''', (job_id,))]
+        return data
+
+    def _status(self, job_id: str) -> Optional[str]:
+        row = get_connection().execute('SELECT status FROM broadcast_jobs WHERE id = ?', (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def _notify(self, job: Dict, result: Dict):
+        event = self._waiters.get(job['id'])
+        if event is not None:
+            event.set()
+        async_waiter = self._async_waiters.get(job['id'])
+        if async_waiter is not None:
+            loop, async_event = async_waiter
+            loop.call_soon_threadsafe(async_event.set)
+
+# Instância global do gerenciador de jobs
+job_manager = None
+
+def get_job_manager() -> JobManager:
+    """Retorna o gerenciador de jobs do processo"""
+    global job_manager
+
+    if job_manager is None:
+        job_manager = JobManager()
+
+    return job_manager
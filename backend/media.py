@@ -0,0 +1,176 @@
+"""
+Mídias de broadcast (fotos, vídeos e documentos)
+
+O arquivo é enviado ao Telegram uma única vez: o ``file_id`` devolvido no
+primeiro envio fica em ``media_cache`` e é reutilizado para os demais grupos
+e para campanhas futuras (inclusive de outros usuários com o mesmo arquivo).
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+from typing import BinaryIO, Dict, Optional
+
+from telegram import InputFile
+from telegram.error import BadRequest
+
+from database import transaction
+
+logger = logging.getLogger(__name__)
+
+# Diretório dos arquivos recebidos (mantidos para um novo upload se o file_id expirar)
+MEDIA_DIR = os.getenv('MEDIA_DIR', 'media')
+# Tamanho máximo aceito; a Bot API limita uploads a 50 MB
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', 50 * 1024 * 1024))
+
+MEDIA_TYPES = ('photo', 'video', 'document')
+
+# Limite da Bot API para legendas
+MAX_CAPTION_LENGTH = 1024
+# Limite da Bot API para fotos (sendPhoto); acima disso, envie como documento
+PHOTO_MAX_BYTES = 10 * 1024 * 1024
+
+CHUNK_SIZE = 1024 * 1024
+
+def guess_media_type(mimetype: Optional[str]) -> str:
+    """Tipo de envio a partir do mimetype do arquivo"""
+    if mimetype in ('image/jpeg', 'image/png', 'image/webp'):
+        return 'photo'
+    if mimetype and mimetype.startswith('video/'):
+        return 'video'
+    return 'document'
+
+def store_upload(stream: BinaryIO, file_name: str, mime_type: Optional[str],
+                 media_type: str, user_id: int) -> Dict:
+    """Grava o arquivo (deduplicado pelo sha256) e registra a mídia do usuário"""
+    max_bytes = min(MEDIA_MAX_BYTES, PHOTO_MAX_BYTES) if media_type == 'photo' else MEDIA_MAX_BYTES
+    os.makedirs(MEDIA_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=MEDIA_DIR, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    if max_bytes < MEDIA_MAX_BYTES:
+                        raise ValueError(f'Foto maior que {max_bytes // (1024 * 1024)} MB (limite do Telegram); '
+                                         'envie com type=document')
+                    raise ValueError(f'Arquivo maior que {max_bytes // (1024 * 1024)} MB')
+                digest.update(chunk)
+                out.write(chunk)
+        if size == 0:
+            raise ValueError('Arquivo vazio')
+        sha256 = digest.hexdigest()
+        storage_path = os.path.join(MEDIA_DIR, sha256)
+        os.replace(temp_path, storage_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    with transaction() as conn:
+        # O file_id pertence ao bot: se o arquivo já foi enviado por alguém, reaproveita
+        shared = conn.execute('''
+            SELECT file_id, file_unique_id FROM media_cache
+            WHERE sha256 = ? AND media_type = ? AND file_id IS NOT NULL
+            LIMIT 1
+        ''', (sha256, media_type)).fetchone()
+        conn.execute('''
+            INSERT INTO media_cache (user_id, sha256, media_type, file_name, mime_type, size,
+                                     storage_path, file_id, file_unique_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, sha256, media_type) DO UPDATE SET
+                file_name = excluded.file_name,
+                file_id = COALESCE(media_cache.file_id, excluded.file_id),
+                file_unique_id = COALESCE(media_cache.file_unique_id, excluded.file_unique_id),
+                last_used_at = CURRENT_TIMESTAMP
+        ''', (user_id, sha256, media_type, file_name, mime_type, size, storage_path,
+              shared[0] if shared else None, shared[1] if shared else None))
+        row = conn.execute('''
+            SELECT id, media_type, file_name, size, file_id FROM media_cache
+            WHERE user_id = ? AND sha256 = ? AND media_type = ?
+        ''', (user_id, sha256, media_type)).fetchone()
+
+    return {
+        'id': row['id'],
+        'media_type': row['media_type'],
+        'file_name': row['file_name'],
+        'size': row['size'],
+        'cached': row['file_id'] is not None
+    }
+
+def record_file_id(sha256: str, media_type: str, file_id: Optional[str], file_unique_id: Optional[str] = None):
+    """Guarda (ou limpa) o file_id de um arquivo para todos os usuários que o enviaram"""
+    with transaction() as conn:
+        conn.execute('''
+            UPDATE media_cache SET file_id = ?, file_unique_id = ?, last_used_at = CURRENT_TIMESTAMP
+            WHERE sha256 = ? AND media_type = ?
+        ''', (file_id, file_unique_id, sha256, media_type))
+
+def file_id_from_message(message, media_type: str):
+    """(file_id, file_unique_id) da mídia de uma mensagem enviada"""
+    if media_type == 'photo':
+        attachment = message.photo[-1] if message.photo else None
+    else:
+        attachment = getattr(message, media_type, None) or message.effective_attachment
+    if attachment is None:
+        return None, None
+    return attachment.file_id, attachment.file_unique_id
+
+def read_file(path: str) -> bytes:
+    with open(path, 'rb') as fh:
+        return fh.read()
+
+def is_invalid_file_id(error: Exception) -> bool:
+    """O Telegram recusou o file_id (ex.: token do bot trocado)"""
+    text = str(error).lower()
+    return isinstance(error, BadRequest) and 'file' in text and ('identifier' in text or 'file_id' in text)
+
+class MediaUploads:
+    """Garante um único upload por arquivo durante o fan-out"""
+
+    def __init__(self):
+        self._file_ids: Dict[tuple, str] = {}
+        self._locks: Dict[tuple, asyncio.Lock] = {}
+
+    async def send(self, service, chat_id: str, media: Dict, caption: Optional[str]):
+        """Envia a mídia para um chat, fazendo o upload apenas se ainda não houver file_id"""
+        key = (media['sha256'], media['media_type'])
+        file_id = self._file_ids.get(key) or media.get('file_id')
+        if file_id:
+            try:
+                return await service.send_media(chat_id, media['media_type'], file_id, caption)
+            except BadRequest as e:
+                if not is_invalid_file_id(e):
+                    raise
+                logger.warning(f"file_id inválido para {media['file_name']}; reenviando o arquivo")
+                self._file_ids.pop(key, None)
+                media['file_id'] = None
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            file_id = self._file_ids.get(key)
+            if not file_id:
+                # Os demais envios desta mídia aguardam este upload e usam o file_id
+                return await self._upload(service, chat_id, media, caption)
+        return await service.send_media(chat_id, media['media_type'], file_id, caption)
+
+    async def _upload(self, service, chat_id: str, media: Dict, caption: Optional[str]):
+        loop = asyncio.get_running_loop()
+        # Leitura do disco fora do event loop
+        data = await loop.run_in_executor(None, read_file, media['path'])
+        message = await service.send_media(
+            chat_id, media['media_type'], lambda: InputFile(data, filename=media['file_name']), caption)
+        file_id, file_unique_id = file_id_from_message(message, media['media_type'])
+        if file_id:
+            self._file_ids[(media['sha256'], media['media_type'])] = file_id
+            await loop.run_in_executor(
+                None, record_file_id, media['sha256'], media['media_type'], file_id, file_unique_id)
+            logger.info(f"Upload de {media['file_name']} concluído; file_id reaproveitado nos próximos envios")
+        return message
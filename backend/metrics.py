@@ -0,0 +1,186 @@
+"""
+Métricas no formato de texto do Prometheus
+
+Contadores, gauges e histogramas simples, sem dependências externas. As
+métricas são por processo: com vários workers do gunicorn, cada um expõe os
+próprios valores em /metrics (agregue por instância no Prometheus).
+"""
+
+import bisect
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Desliga a coleta (e a instrumentação do SQLite) quando 0
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') != '0'
+
+# Buckets (segundos) para latências de requisições e chamadas externas
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Buckets menores para consultas ao SQLite
+QUERY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """Base: nome, ajuda e rótulos"""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+class Counter(Metric):
+    """Valor que só cresce"""
+
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}' for key, value in items]
+
+class Gauge(Metric):
+    """Valor que sobe e desce; pode ser calculado na coleta via ``callback``"""
+
+    kind = 'gauge'
+
+    def __init__(self, *args, callback: Optional[Callable[[], Dict[Tuple, float]]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple, float] = {}
+        self.callback = callback
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def collect(self) -> List[str]:
+        if self.callback is not None:
+            try:
+                values = self.callback()
+            except Exception:
+                return []
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}' for key, value in values.items()]
+
+class Histogram(Metric):
+    """Distribuição por buckets (contagens, soma e total)"""
+
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets: Sequence[float] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # [contagem por bucket (não acumulada) + overflow, soma]
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        lines = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {cumulative}')
+        return lines
+
+class Registry:
+    """Conjunto de métricas expostas em /metrics"""
+
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+http_request_duration = registry.register(Histogram(
+    'http_request_duration_seconds', 'Latência das requisições HTTP por rota',
+    ('method', 'route', 'status')))
+sqlite_query_duration = registry.register(Histogram(
+    'sqlite_query_duration_seconds', 'Tempo de execução das consultas ao SQLite',
+    ('operation',), buckets=QUERY_BUCKETS))
+telegram_request_duration = registry.register(Histogram(
+    'telegram_request_duration_seconds', 'Latência das chamadas à Bot API', ('method',)))
+telegram_errors = registry.register(Counter(
+    'telegram_errors_total', 'Erros da Bot API por classe', ('method', 'error')))
+broadcast_messages = registry.register(Counter(
+    'broadcast_messages_total', 'Entregas de broadcast por resultado', ('status',)))
+telegram_sends_in_flight = registry.register(Gauge(
+    'telegram_sends_in_flight', 'Envios ao Telegram em andamento'))
+
+def register_gauge(name: str, documentation: str, callback: Callable[[], Dict[Tuple, float]],
+                   labels: Sequence[str] = ()) -> Gauge:
+    """Gauge calculado no momento da coleta (ex.: linhas pendentes na outbox)"""
+    return registry.register(Gauge(name, documentation, labels, callback=callback))
+
+QUERY_OPERATIONS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'CREATE', 'PRAGMA', 'BEGIN', 'COMMIT', 'ROLLBACK'}
+
+def query_operation(sql: str) -> str:
+    """Primeira palavra do SQL (SELECT, INSERT...) usada como rótulo"""
+    head = sql.lstrip()[:10].split(None, 1)
+    operation = head[0].upper() if head else ''
+    return operation if operation in QUERY_OPERATIONS else 'OTHER'
+
+def observe_query(sql: str, elapsed: float):
+    sqlite_query_duration.observe(elapsed, query_operation(sql))
+
+def render() -> str:
+    """Texto no formato de exposição do Prometheus"""
+    return registry.render()
@@ -7,17 +7,15 @@ import hashlib
 from datetime import datetime
 from typing import List, Dict, Optional
 
-DATABASE_PATH = 'bot_database.db'
+import database
 
 class DatabaseManager:
     """Gerenciador de conexões com o banco de dados"""
     
     @staticmethod
     def get_connection():
-        """Retorna uma conexão com o banco de dados"""
-        conn = sqlite3.connect(DATABASE_PATH)
-        conn.row_factory = sqlite3.Row  # Permite acesso por nome da coluna
-        return conn
+        """Retorna a conexão da thread atual (WAL, reaproveitada entre chamadas)"""
+        return database.get_connection()
 
 class Admin:
     """Modelo para administradores"""
@@ -37,7 +35,6 @@ class Admin:
         ''', (username, password_hash))
         
         result = cursor.fetchone()
-        conn.close()
         
         if result:
             return {
@@ -63,9 +60,8 @@ class Admin:
             conn.commit()
             return True
         except sqlite3.IntegrityError:
+            conn.rollback()
             return False
-        finally:
-            conn.close()
     
     @staticmethod
     def get_all() -> List[Dict]:
@@ -75,7 +71,6 @@ class Admin:
         
         cursor.execute('SELECT id, username, created_at FROM admins ORDER BY username')
         results = cursor.fetchall()
-        conn.close()
         
         return [dict(row) for row in results]
     
@@ -93,7 +88,6 @@ class Admin:
         
         success = cursor.rowcount > 0
         conn.commit()
-        conn.close()
         
         return success
     
@@ -105,7 +99,6 @@ class Admin:
         
         cursor.execute('SELECT id FROM admins WHERE username = ?', (username,))
         result = cursor.fetchone()
-        conn.close()
         
         return result is not None
 
@@ -120,7 +113,6 @@ class Admin:
         
         cursor.execute('SELECT * FROM groups WHERE active = 1 ORDER BY name')
         results = cursor.fetchall()
-        conn.close()
         
         return [dict(row) for row in results]
     
@@ -138,9 +130,8 @@ class Admin:
             conn.commit()
             return True
         except sqlite3.IntegrityError:
+            conn.rollback()
             return False
-        finally:
-            conn.close()
     
     @staticmethod
     def update_status(group_id: int, active: bool) -> bool:
@@ -154,7 +145,6 @@ class Admin:
         
         success = cursor.rowcount > 0
         conn.commit()
-        conn.close()
         
         return success
     
@@ -174,7 +164,6 @@ class Admin:
         ''', group_ids)
         
         results = cursor.fetchall()
-        conn.close()
         
         return [dict(row) for row in results]
 
@@ -189,7 +178,6 @@ class Template:
         
         cursor.execute('SELECT * FROM templates ORDER BY name')
         results = cursor.fetchall()
-        conn.close()
         
         return [dict(row) for row in results]
     
@@ -205,7 +193,6 @@ class Template:
         ''', (name, content))
         
         conn.commit()
-        conn.close()
         return True
     
     @staticmethod
@@ -221,7 +208,6 @@ class Template:
         
         success = cursor.rowcount > 0
         conn.commit()
-        conn.close()
         
         return success
     
@@ -235,7 +221,6 @@ class Template:
         
         success = cursor.rowcount > 0
         conn.commit()
-        conn.close()
         
         return success
     
@@ -247,7 +232,6 @@ class Template:
         
         cursor.execute('SELECT * FROM templates WHERE id = ?', (template_id,))
         result = cursor.fetchone()
-        conn.close()
         
         return dict(result) if result else None
 
@@ -266,7 +250,6 @@ class MessageHistory:
         ''', (message_text, groups_sent, status))
         
         conn.commit()
-        conn.close()
         return True
     
     @staticmethod
@@ -282,36 +265,33 @@ class MessageHistory:
         ''', (limit,))
         
         results = cursor.fetchall()
-        conn.close()
         
         return [dict(row) for row in results]
     
     @staticmethod
     def get_stats() -> Dict:
-        """Retorna estatísticas do histórico"""
+        """Retorna estatísticas do histórico (a partir dos contadores por usuário)"""
         conn = DatabaseManager.get_connection()
         cursor = conn.cursor()
         
         # Total de mensagens enviadas
-        cursor.execute('SELECT COUNT(*) FROM message_history WHERE status = "sent"')
+        cursor.execute('SELECT COALESCE(SUM(total_messages), 0) FROM tenant_counters')
         total_messages = cursor.fetchone()[0]
         
         # Mensagens enviadas hoje
         cursor.execute('''
-            SELECT COUNT(*) FROM message_history 
-            WHERE DATE(sent_at) = DATE('now') AND status = 'sent'
+            SELECT COALESCE(SUM(messages_sent), 0) FROM tenant_daily_counters 
+            WHERE day = DATE('now')
         ''')
         messages_today = cursor.fetchone()[0]
         
         # Mensagens desta semana
         cursor.execute('''
-            SELECT COUNT(*) FROM message_history 
-            WHERE DATE(sent_at) >= DATE('now', '-7 days') AND status = 'sent'
+            SELECT COALESCE(SUM(messages_sent), 0) FROM tenant_daily_counters 
+            WHERE day >= DATE('now', '-7 days')
         ''')
         messages_week = cursor.fetchone()[0]
         
-        conn.close()
-        
         return {
             'total_messages': total_messages,
             'messages_today': messages_today,
@@ -329,7 +309,6 @@ class Settings:
         
         cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
         result = cursor.fetchone()
-        conn.close()
         
         return result['value'] if result else default_value
     
@@ -345,7 +324,6 @@ class Settings:
         ''', (key, value))
         
         conn.commit()
-        conn.close()
         return True
     
     @staticmethod
@@ -356,6 +334,5 @@ class Settings:
         
         cursor.execute('SELECT key, value FROM settings')
         results = cursor.fetchall()
-        conn.close()
         
         return {row['key']: row['value'] for row in results}
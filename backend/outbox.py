@@ -0,0 +1,307 @@
+"""
+Outbox persistente de envios
+
+Cada entrega pendente de um broadcast é uma linha da tabela ``outbox``.
+Workers reivindicam lotes de linhas, enviam e marcam o resultado; um
+broadcast interrompido por restart ou deploy é retomado de onde parou, sem
+reenviar o que já foi entregue (só as linhas que estavam em envio quando o
+processo caiu podem sair de novo).
+
+Apenas um processo por banco envia (lock em ``OUTBOX_LOCK_PATH``): os
+limites de taxa do Telegram valem para o bot inteiro, e o token bucket de
+``rate_limiter`` só os garante dentro de um processo. Os demais workers do
+gunicorn apenas enfileiram e assumem o envio se o processo atual sair.
+"""
+
+import asyncio
+import fcntl
+import logging
+import os
+import sqlite3
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from async_runtime import get_runtime
+from database import DATABASE_PATH, get_connection, transaction
+from telegram_service import get_telegram_service
+from template_engine import get_template_cache, group_context, send_context
+
+logger = logging.getLogger(__name__)
+
+# Número de laços de envio concorrentes no processo que envia
+BROADCAST_JOB_WORKERS = int(os.getenv('BROADCAST_JOB_WORKERS', 2))
+# Linhas reivindicadas por vez por cada laço
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 100))
+# Reivindicações máximas de uma mesma linha antes de desistir (restarts durante o envio)
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 3))
+# Intervalo de verificação de trabalho enfileirado por outros processos
+OUTBOX_POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', 1))
+# Lock que elege o processo que envia (precisa ser o mesmo para todos os workers)
+OUTBOX_LOCK_PATH = os.getenv('OUTBOX_LOCK_PATH', f'{DATABASE_PATH}.outbox.lock')
+
+_job_listeners: List[Callable[[Dict, Dict], None]] = []
+_completed_listeners: List[Callable[[Dict, Dict], None]] = []
+
+def on_job_complete(callback: Callable[[Dict, Dict], None]):
+    """Registra ``callback(job, result)`` executado na transação que conclui o broadcast
+
+    Uma exceção no callback desfaz a conclusão; o job é concluído de novo na
+    próxima varredura (``stalled_jobs``).
+    """
+    _job_listeners.append(callback)
+
+def after_job_complete(callback: Callable[[Dict, Dict], None]):
+    """Registra ``callback(job, result)`` chamado depois do commit da conclusão"""
+    _completed_listeners.append(callback)
+
+def recover_claims() -> int:
+    """Devolve à fila as linhas deixadas em 'sending' pelo processo anterior
+
+    Chamado uma vez, ao obter o lock de envio: quem reivindicou essas linhas
+    morreu (o lock só é liberado quando o processo sai). Linhas que já
+    esgotaram as tentativas são marcadas como falhas; os jobs delas são
+    concluídos pela varredura de ``stalled_jobs``. Retorna as linhas devolvidas.
+    """
+    with transaction(immediate=True) as conn:
+        conn.execute('''
+            UPDATE outbox SET status = 'failed', error = 'Tentativas esgotadas', updated_at = CURRENT_TIMESTAMP
+            WHERE status = 'sending' AND attempts >= ?
+        ''', (OUTBOX_MAX_ATTEMPTS,))
+        return conn.execute('''
+            UPDATE outbox SET status = 'pending', updated_at = CURRENT_TIMESTAMP
+            WHERE status = 'sending'
+        ''').rowcount
+
+def claim_batch(limit: int) -> List[Dict]:
+    """Reivindica linhas pendentes para envio
+
+    Só o processo que tem o lock de envio chama esta função, então linhas em
+    'sending' estão sempre em andamento nele e nunca são reivindicadas de novo.
+    """
+    with transaction(immediate=True) as conn:
+        rows = conn.execute('''
+            SELECT o.id, o.job_id, o.group_id, o.chat_id, o.group_name,
+                   j.message_text, j.template_id, j.template_version, j.media_id,
+                   m.sha256, m.media_type, m.file_id, m.storage_path, m.file_name
+            FROM outbox o JOIN broadcast_jobs j ON j.id = o.job_id
+            LEFT JOIN media_cache m ON m.id = j.media_id
+            WHERE o.status = 'pending'
+            ORDER BY o.id
+            LIMIT ?
+        ''', (limit,)).fetchall()
+        if rows:
+            conn.executemany('''
+                UPDATE outbox SET status = 'sending', attempts = attempts + 1,
+                       claimed_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', [(row['id'],) for row in rows])
+            job_ids = sorted({row['job_id'] for row in rows})
+            placeholders = ','.join('?' * len(job_ids))
+            conn.execute(f'''
+                UPDATE broadcast_jobs SET status = 'running', started_at = CURRENT_TIMESTAMP
+                WHERE id IN ({placeholders}) AND status = 'queued'
+            ''', job_ids)
+
+    return [dict(row) for row in rows]
+
+def mark_delivery(outbox_id: int, error: Optional[str], message_id: Optional[int] = None):
+    """Registra o resultado do envio de uma linha"""
+    with transaction() as conn:
+        conn.execute('''
+            UPDATE outbox SET status = ?, error = ?, telegram_message_id = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', ('sent' if error is None else 'failed', error, message_id, outbox_id))
+
+def job_result(conn: sqlite3.Connection, job_id: str) -> Dict:
+    """Monta o resultado de um broadcast no formato de /api/send_message"""
+    sent_groups = []
+    failed_groups = []
+    for name, status, error in conn.execute(
+            'SELECT group_name, status, error FROM outbox WHERE job_id = ? ORDER BY id', (job_id,)):
+        if status == 'sent':
+            sent_groups.append(name)
+        elif status == 'failed':
+            failed_groups.append(f"{name}: {error}")
+    return {
+        'sent_groups': sent_groups,
+        'failed_groups': failed_groups,
+        'total_sent': len(sent_groups),
+        'total_failed': len(failed_groups)
+    }
+
+def stalled_jobs(limit: int = OUTBOX_BATCH_SIZE) -> List[str]:
+    """Jobs sem entregas em aberto que ainda não foram concluídos
+
+    Sobram quando o processo cai entre a última entrega e a conclusão, ou
+    quando um listener de ``on_job_complete`` falha.
+    """
+    rows = get_connection().execute('''
+        SELECT id FROM broadcast_jobs j
+        WHERE status IN ('queued', 'running')
+          AND NOT EXISTS (
+              SELECT 1 FROM outbox WHERE job_id = j.id AND status IN ('pending', 'sending')
+          )
+        LIMIT ?
+    ''', (limit,)).fetchall()
+    return [row[0] for row in rows]
+
+def finalize_job(job_id: str) -> bool:
+    """Conclui o job se não houver entregas em aberto e notifica os listeners
+
+    Os listeners de ``on_job_complete`` gravam na mesma transação que marca o
+    job como concluído; se algum falhar, tudo é desfeito e a exceção sobe.
+    Apenas um processo consegue concluir cada job, então os listeners rodam
+    uma única vez por broadcast.
+    """
+    with transaction(immediate=True) as conn:
+        cursor = conn.execute('''
+            UPDATE broadcast_jobs SET status = 'completed', finished_at = CURRENT_TIMESTAMP,
+                   started_at = COALESCE(started_at, CURRENT_TIMESTAMP)
+            WHERE id = ? AND status != 'completed'
+              AND NOT EXISTS (
+                  SELECT 1 FROM outbox WHERE job_id = ? AND status IN ('pending', 'sending')
+              )
+        ''', (job_id, job_id))
+        if cursor.rowcount == 0:
+            return False
+
+        job = dict(conn.execute('SELECT * FROM broadcast_jobs WHERE id = ?', (job_id,)).fetchone())
+        result = job_result(conn, job_id)
+        for callback in _job_listeners:
+            callback(job, result)
+
+    for callback in _completed_listeners:
+        try:
+            callback(job, result)
+        except Exception as e:
+            logger.error(f"Erro ao notificar a conclusão do job {job_id}: {e}")
+    return True
+
+class OutboxWorker:
+    """Processa a outbox no runtime assíncrono compartilhado"""
+
+    def __init__(self, workers: int = BROADCAST_JOB_WORKERS):
+        self.workers = max(1, workers)
+        self._pid = None
+        self._loop = None
+        self._wakeup = None
+        self._lock = threading.Lock()
+        self._sender_lock = None
+
+    def start(self):
+        """Inicia o worker (idempotente); envia quando este processo obtiver o lock"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            get_runtime().submit(self._main())
+
+    def wake(self):
+        """Avisa os laços de que há novas linhas na outbox"""
+        if self._loop and self._wakeup and self._pid == os.getpid():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _acquire_sender_lock(self) -> bool:
+        """Tenta se tornar o processo que envia; o lock dura até o processo sair"""
+        handle = open(OUTBOX_LOCK_PATH, 'a')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            handle.close()
+            return False
+        self._sender_lock = handle
+        return True
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        if not self._acquire_sender_lock():
+            logger.info("Outro processo já envia a outbox; este apenas enfileira")
+            while not self._acquire_sender_lock():
+                await asyncio.sleep(OUTBOX_POLL_SECONDS)
+        while True:
+            try:
+                recovered = await self._loop.run_in_executor(None, recover_claims)
+                break
+            except Exception as e:
+                logger.error(f"Erro ao retomar a outbox: {e}")
+                await asyncio.sleep(OUTBOX_POLL_SECONDS)
+        logger.info(f"Worker da outbox iniciado (pid {os.getpid()}, {recovered} envios retomados)")
+        await asyncio.gather(*(self._work() for _ in range(self.workers)))
+
+    async def _work(self):
+        while True:
+            try:
+                processed = await self._process_batch()
+            except Exception as e:
+                logger.error(f"Erro ao processar a outbox: {e}")
+                processed = False
+
+            if not processed:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def _process_batch(self) -> bool:
+        loop = asyncio.get_running_loop()
+        rows = await loop.run_in_executor(None, claim_batch, OUTBOX_BATCH_SIZE)
+        job_ids = set()
+
+        if rows:
+            # Cada template é compilado uma vez; por grupo só há a junção dos segmentos
+            templates = get_template_cache()
+            compiled = {}  # job_id -> template: o cache (e o hash do texto) é consultado uma vez por job
+            base_context = send_context()
+            groups = []
+            for row in rows:
+                group = {
+                    'outbox_id': row['id'],
+                    'id': row['group_id'],
+                    'chat_id': row['chat_id'],
+                    'name': row['group_name']
+                }
+                template = compiled.get(row['job_id'])
+                if template is None:
+                    template = compiled[row['job_id']] = templates.get(
+                        row['message_text'], row['template_id'], row['template_version'])
+                group['text'] = template.render(group_context(base_context, group))
+                if row['media_id'] and row['sha256']:
+                    group['media'] = {
+                        'sha256': row['sha256'],
+                        'media_type': row['media_type'],
+                        'file_id': row['file_id'],
+                        'path': row['storage_path'],
+                        'file_name': row['file_name']
+                    }
+                groups.append(group)
+            marks = []
+
+            def on_result(group: Dict, error: Optional[str], message_id: Optional[int]):
+                marks.append(loop.run_in_executor(None, mark_delivery, group['outbox_id'], error, message_id))
+
+            await get_telegram_service().send_message_to_groups(groups, None, on_result=on_result)
+            await asyncio.gather(*marks)
+            job_ids.update(row['job_id'] for row in rows)
+        else:
+            job_ids.update(await loop.run_in_executor(None, stalled_jobs))
+
+        for job_id in job_ids:
+            try:
+                await loop.run_in_executor(None, finalize_job, job_id)
+            except Exception as e:
+                logger.error(f"Erro ao concluir o job {job_id}: {e}")
+        return bool(rows)
+
+# Instância global do worker
+outbox_worker = None
+
+def get_outbox_worker() -> OutboxWorker:
+    """Retorna o worker da outbox do processo"""
+    global outbox_worker
+
+    if outbox_worker is None:
+        outbox_worker = OutboxWorker()
+
+    return outbox_worker
@@ -0,0 +1,106 @@
+"""
+Hash de senhas fora da thread da requisição
+
+bcrypt custa 100-300 ms de CPU por chamada; um pico de logins não pode
+travar as demais rotas. As chamadas rodam em um pool dedicado e limitado
+(o bcrypt libera o GIL durante o hash) e, quando a fila enche, a requisição
+recebe 503 em vez de aguardar indefinidamente.
+"""
+
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import bcrypt
+
+from database import transaction
+
+logger = logging.getLogger(__name__)
+
+# Fator de custo do bcrypt; hashes com outro custo são refeitos no login
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+# Threads dedicadas ao hash
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+# Operações em execução + na fila antes de recusar novas
+PASSWORD_HASH_QUEUE = int(os.getenv('PASSWORD_HASH_QUEUE', 16))
+# Tempo máximo de espera por uma vaga na fila (segundos)
+PASSWORD_HASH_WAIT = float(os.getenv('PASSWORD_HASH_WAIT', 2))
+
+_COST_RE = re.compile(r'^\$2[abxy]?\$(\d{2})\$')
+
+class HasherBusy(Exception):
+    """Fila de hash cheia: o cliente deve tentar novamente"""
+
+class PasswordHasher:
+    """Pool limitado para bcrypt.hashpw / bcrypt.checkpw"""
+
+    def __init__(self, rounds: int = BCRYPT_ROUNDS, workers: int = PASSWORD_HASH_WORKERS,
+                 queue_size: int = PASSWORD_HASH_QUEUE, wait: float = PASSWORD_HASH_WAIT):
+        self.rounds = rounds
+        self.wait = wait
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(max(1, queue_size))
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.wait):
+            raise HasherBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def hash(self, password: str) -> str:
+        """Gera o hash da senha com o custo configurado"""
+        return self._run(self._hash, password).result()
+
+    def check(self, password: str, stored_hash) -> bool:
+        """Confere a senha contra o hash armazenado"""
+        if isinstance(stored_hash, str):
+            stored_hash = stored_hash.encode()
+        return self._run(bcrypt.checkpw, password.encode(), stored_hash).result()
+
+    def needs_rehash(self, stored_hash) -> bool:
+        """Hash gerado com custo diferente do atual"""
+        if isinstance(stored_hash, bytes):
+            stored_hash = stored_hash.decode()
+        match = _COST_RE.match(stored_hash or '')
+        return match is None or int(match.group(1)) != self.rounds
+
+    def rehash_in_background(self, user_id: int, password: str):
+        """Atualiza o hash do usuário sem atrasar a resposta do login"""
+        try:
+            self._run(self._rehash, user_id, password)
+        except HasherBusy:
+            # Fica para o próximo login
+            pass
+
+    def _hash(self, password: str) -> str:
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt(self.rounds)).decode()
+
+    def _rehash(self, user_id: int, password: str):
+        try:
+            with transaction() as conn:
+                conn.execute('UPDATE users SET password_hash = ? WHERE id = ?', (self._hash(password), user_id))
+        except Exception as e:
+            logger.error(f"Erro ao atualizar o hash da senha do usuário {user_id}: {e}")
+
+# Instância global do pool de hash
+password_hasher = None
+_password_hasher_pid = None
+
+def get_password_hasher() -> PasswordHasher:
+    """Retorna o pool de hash de senhas do processo"""
+    global password_hasher, _password_hasher_pid
+
+    # Threads do pool não sobrevivem a um fork (workers do gunicorn)
+    if password_hasher is None or _password_hasher_pid != os.getpid():
+        password_hasher = PasswordHasher()
+        _password_hasher_pid = os.getpid()
+
+    return password_hasher
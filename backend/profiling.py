@@ -0,0 +1,197 @@
+"""
+Perfil de requisições sob demanda
+
+Uma requisição é perfilada quando um admin envia o cabeçalho
+``X-Profile: 1`` ou por amostragem (``PROFILE_SAMPLE_RATE``). O cProfile
+cobre a thread da requisição e, nas views async, o event loop enquanto a
+corrotina roda; as consultas SQL (inclusive as do pool assíncrono) são
+contadas e cronometradas por statement.
+
+Para cada requisição perfilada são gravados em ``PROFILE_DIR`` o dump do
+cProfile (``.prof``, para pstats/snakeviz) e um resumo em texto com as
+consultas e as funções mais custosas, nomeados por rota e id da requisição.
+Apenas uma requisição por processo é perfilada por vez.
+"""
+
+import contextvars
+import cProfile
+import datetime
+import io
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Fração das requisições perfiladas automaticamente (0 desliga)
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+# Permite que admins peçam o perfil com o cabeçalho X-Profile: 1
+PROFILE_HEADER_ENABLED = os.getenv('PROFILE_HEADER_ENABLED', '1') != '0'
+# Diretório dos perfis gravados
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+# Funções listadas no resumo
+PROFILE_TOP_N = int(os.getenv('PROFILE_TOP_N', 40))
+
+PROFILE_HEADER = 'X-Profile'
+PROFILING_ENABLED = PROFILE_SAMPLE_RATE > 0 or PROFILE_HEADER_ENABLED
+
+_current: contextvars.ContextVar = contextvars.ContextVar('request_profile', default=None)
+_active = threading.Lock()
+
+class RequestProfile:
+    """Perfil em andamento de uma requisição"""
+
+    def __init__(self, request_id: str, method: str, path: str, route: str, reason: str):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.route = route
+        self.reason = reason
+        self.started = time.perf_counter()
+        self.query_count = 0
+        self.query_time = 0.0
+        self.queries: Dict[str, List] = {}  # statement -> [execuções, tempo total]
+        self._profiles: List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+        self._token = None
+
+    def record_query(self, sql: str, elapsed: float):
+        statement = ' '.join(sql.split())
+        with self._lock:
+            self.query_count += 1
+            self.query_time += elapsed
+            entry = self.queries.setdefault(statement, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def profiler(self) -> cProfile.Profile:
+        """Novo cProfile para a thread atual (cada thread tem o seu)"""
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        return profile
+
+    def summary(self, status: int, elapsed: float, user_id=None, stats: Optional[pstats.Stats] = None) -> str:
+        lines = [
+            f'{self.method} {self.path}',
+            f'rota: {self.route}  status: {status}  usuário: {user_id}  motivo: {self.reason}',
+            f'id: {self.request_id}  tempo: {elapsed * 1000:.1f} ms',
+            f'SQL: {self.query_count} consultas, {self.query_time * 1000:.1f} ms',
+            '',
+            'Consultas (por tempo total):',
+        ]
+        ranked = sorted(self.queries.items(), key=lambda item: item[1][1], reverse=True)
+        for statement, (count, total) in ranked:
+            lines.append(f'  {count:>5}x {total * 1000:>9.2f} ms  {statement[:200]}')
+
+        if stats is not None:
+            buffer = io.StringIO()
+            stats.stream = buffer
+            stats.sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+            lines += ['', buffer.getvalue()]
+        return '\n'.join(lines) + '\n'
+
+    def stats(self) -> Optional[pstats.Stats]:
+        """Estatísticas das threads perfiladas, combinadas"""
+        stats = None
+        for profile in self._profiles:
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        return stats
+
+def should_profile(requested: bool, is_admin: bool) -> Optional[str]:
+    """Motivo para perfilar a requisição ('header' ou 'amostra') ou None"""
+    if requested and is_admin and PROFILE_HEADER_ENABLED:
+        return 'header'
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return 'amostra'
+    return None
+
+def begin(method: str, path: str, route: str, reason: str, request_id: Optional[str] = None) -> Optional[RequestProfile]:
+    """Inicia o perfil na thread atual; None se outro perfil já estiver em andamento"""
+    if not _active.acquire(blocking=False):
+        return None
+    # O id entra no nome do arquivo: apenas caracteres seguros
+    request_id = re.sub(r'[^A-Za-z0-9_-]', '', request_id or '')[:64] or uuid.uuid4().hex[:12]
+    profile = RequestProfile(request_id, method, path, route, reason)
+    profile._token = _current.set(profile)
+    profile.profiler().enable()
+    return profile
+
+def end(profile: RequestProfile, status: int, user_id=None) -> Optional[str]:
+    """Encerra o perfil, grava os arquivos e retorna o caminho do resumo"""
+    try:
+        profile._profiles[0].disable()
+        elapsed = time.perf_counter() - profile.started
+        _clear(profile)
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stamp = datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+        route = re.sub(r'[^A-Za-z0-9]+', '_', profile.route).strip('_') or 'unmatched'
+        base = os.path.join(PROFILE_DIR, f'{stamp}-{route}-{profile.request_id}')
+
+        stats = profile.stats()
+        summary = profile.summary(status, elapsed, user_id, stats)
+        if stats is not None:
+            stats.dump_stats(base + '.prof')
+        with open(base + '.txt', 'w', encoding='utf-8') as f:
+            f.write(summary)
+        logger.info(f"Perfil de {profile.method} {profile.route} salvo em {base}.txt "
+                    f"({profile.query_count} consultas SQL)")
+        return base + '.txt'
+    except Exception as e:
+        logger.error(f"Erro ao gravar o perfil {profile.request_id}: {e}")
+        return None
+    finally:
+        _active.release()
+
+def discard():
+    """Descarta um perfil que não chegou a ``end`` (erro não tratado na requisição)"""
+    profile = _current.get()
+    if profile is None:
+        return
+    profile._profiles[0].disable()
+    _clear(profile)
+    _active.release()
+
+def _clear(profile: RequestProfile):
+    try:
+        _current.reset(profile._token)
+    except ValueError:
+        # Contexto diferente do que iniciou o perfil
+        _current.set(None)
+
+def current() -> Optional[RequestProfile]:
+    return _current.get()
+
+def record_query(sql: str, elapsed: float):
+    """Chamado pelo cursor instrumentado a cada consulta"""
+    profile = _current.get()
+    if profile is not None:
+        profile.record_query(sql, elapsed)
+
+async def profile_coroutine(coro):
+    """Perfila a corrotina de uma view async na thread do event loop
+
+    Enquanto ela aguarda, outras tarefas do loop podem aparecer no perfil.
+    """
+    profile = _current.get()
+    if profile is None:
+        return await coro
+    profiler = profile.profiler()
+    profiler.enable()
+    try:
+        return await coro
+    finally:
+        profiler.disable()
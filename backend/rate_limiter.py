@@ -0,0 +1,121 @@
+"""
+Controle de taxa de envio para a API do Telegram
+
+Usa um token bucket global (limite do bot) e um bucket por chat (limite por
+grupo). Quando o Telegram responde 429 (RetryAfter), apenas o chat afetado é
+pausado; os demais continuam enviando.
+"""
+
+import asyncio
+import os
+import time
+from typing import Dict, Optional
+
+# Limites documentados pelo Telegram: ~30 msg/s por bot e ~20 msg/min por grupo.
+# Os buckets são do processo; a outbox envia de um único processo (ver outbox.py).
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_CHAT_RATE_PER_MINUTE = float(os.getenv('TELEGRAM_CHAT_RATE_PER_MINUTE', 20))
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', 3))
+
+# Quantidade máxima de buckets por chat mantidos em memória
+MAX_CHAT_BUCKETS = 10000
+
+class TokenBucket:
+    """Token bucket com suporte a pausa temporária"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Segundos até haver um token disponível (0 se já houver)"""
+        if self.paused_until > now:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        """Suspende o bucket (ex.: após um RetryAfter)"""
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + seconds)
+        # Ao fim da pausa apenas um envio é liberado de imediato
+        self.tokens = 1.0
+        self.updated = max(self.updated, self.paused_until)
+
+    def idle(self, now: float) -> bool:
+        """Bucket cheio e sem pausa pode ser descartado"""
+        self._refill(now)
+        return self.paused_until <= now and self.tokens >= self.capacity
+
+class RateLimiter:
+    """Limitador global + por chat para chamadas ao Telegram"""
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE,
+                 chat_rate_per_minute: float = TELEGRAM_CHAT_RATE_PER_MINUTE,
+                 chat_burst: float = TELEGRAM_CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate_per_minute / 60.0
+        self.chat_burst = chat_burst
+        self.chats: Dict[str, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        key = str(chat_id)
+        bucket = self.chats.get(key)
+        if bucket is None:
+            if len(self.chats) >= MAX_CHAT_BUCKETS:
+                self._prune()
+            bucket = self.chats[key] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _prune(self):
+        now = time.monotonic()
+        for key in [key for key, bucket in self.chats.items() if bucket.idle(now)]:
+            del self.chats[key]
+
+    async def wait_chat(self, chat_id):
+        """Aguarda o chat sair da pausa e ter token, sem consumir nada"""
+        chat_bucket = self._chat_bucket(chat_id)
+        while True:
+            wait = chat_bucket.wait_time(time.monotonic())
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    async def acquire(self, chat_id):
+        """Aguarda até que o envio para o chat respeite ambos os limites"""
+        chat_bucket = self._chat_bucket(chat_id)
+        while True:
+            now = time.monotonic()
+            wait = max(chat_bucket.wait_time(now), self.global_bucket.wait_time(now))
+            if wait <= 0:
+                # Sem await entre a checagem e o consumo: operação atômica no loop
+                chat_bucket.consume()
+                self.global_bucket.consume()
+                return
+            await asyncio.sleep(wait)
+
+    def pause_chat(self, chat_id, seconds: float):
+        """Pausa apenas o chat que recebeu RetryAfter"""
+        self._chat_bucket(chat_id).pause(seconds)
+
+def retry_after_seconds(error) -> Optional[float]:
+    """Extrai o tempo de espera de um RetryAfter (int ou timedelta)"""
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is None:
+        return None
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
@@ -0,0 +1,92 @@
+"""
+Camada de respostas JSON da API
+
+Serializa com orjson quando disponível (com fallback para o json da
+biblioteca padrão) e comprime respostas grandes com br ou gzip, conforme o
+Accept-Encoding do cliente.
+"""
+
+import gzip
+import os
+import sqlite3
+from typing import Dict, Iterable, List
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dependência opcional
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - dependência opcional
+    brotli = None
+
+# Respostas menores que isso (bytes) não compensam a compressão
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+# Nível de compressão (gzip 1-9; para br é usado como quality 0-11)
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/plain', 'text/html', 'text/csv'}
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Provider do Flask que usa orjson em jsonify quando disponível"""
+
+    def dumps(self, obj, **kwargs) -> str:
+        if orjson is None or kwargs.get('indent'):
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def response(self, *args, **kwargs):
+        if orjson is None or (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        # Bytes direto no corpo: evita decodificar e recodificar a string
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=orjson.OPT_APPEND_NEWLINE),
+            mimetype=self.mimetype
+        )
+
+def rows_to_dicts(rows: Iterable[sqlite3.Row], booleans: Iterable[str] = ()) -> List[Dict]:
+    """Converte linhas (sqlite3.Row) em dicts pelos nomes das colunas"""
+    booleans = tuple(booleans)
+    result = []
+    for row in rows:
+        item = dict(zip(row.keys(), row))
+        for column in booleans:
+            item[column] = bool(item[column])
+        result.append(item)
+    return result
+
+def choose_encoding(accept_encoding) -> str:
+    """Melhor codificação aceita pelo cliente: br, gzip ou '' (nenhuma)"""
+    if brotli is not None and accept_encoding['br']:
+        return 'br'
+    if accept_encoding['gzip']:
+        return 'gzip'
+    return ''
+
+def compress_response(response, accept_encoding):
+    """Comprime a resposta se o tipo, o tamanho e o cliente permitirem"""
+    response.vary.add('Accept-Encoding')
+    if (response.direct_passthrough
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    encoding = choose_encoding(accept_encoding)
+    if not encoding:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    if encoding == 'br':
+        data = brotli.compress(data, quality=min(COMPRESS_LEVEL, 11))
+    else:
+        data = gzip.compress(data, compresslevel=min(max(COMPRESS_LEVEL, 1), 9), mtime=0)
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,265 @@
+"""
+Retenção e arquivamento do histórico
+
+Envios mais antigos que ``HISTORY_RETENTION_DAYS`` saem de
+``message_history`` (e suas entregas de ``message_deliveries``) para arquivos
+NDJSON compactados, um por usuário e mês:
+
+    HISTORY_ARCHIVE_DIR/<user_id>/<AAAA-MM>.ndjson.gz
+
+Cada lote é gravado no arquivo (com fsync) antes de ser removido do banco;
+se o processo cair entre as duas etapas o lote é arquivado de novo e a
+busca descarta as cópias pelo id. Os contadores de /api/stats são
+acumulados e não mudam com a remoção. O espaço liberado é devolvido ao
+sistema com ``PRAGMA incremental_vacuum`` (bancos criados antes precisam de
+um ``python retention.py vacuum`` para ativar o auto_vacuum incremental).
+
+Uso: python retention.py [run|vacuum]
+"""
+
+import asyncio
+import datetime
+import fcntl
+import gzip
+import json
+import logging
+import os
+import sys
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from async_runtime import get_runtime
+from database import get_connection, transaction
+
+logger = logging.getLogger(__name__)
+
+# Idade (dias) a partir da qual o histórico é arquivado (0 desliga)
+HISTORY_RETENTION_DAYS = int(os.getenv('HISTORY_RETENTION_DAYS', 0))
+# Diretório dos arquivos compactados
+HISTORY_ARCHIVE_DIR = os.getenv('HISTORY_ARCHIVE_DIR', 'archive')
+# Linhas arquivadas e removidas por transação
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 1000))
+# Intervalo entre execuções automáticas (segundos)
+RETENTION_INTERVAL_SECONDS = float(os.getenv('RETENTION_INTERVAL_SECONDS', 3600))
+# Páginas devolvidas ao sistema por lote removido
+RETENTION_VACUUM_PAGES = int(os.getenv('RETENTION_VACUUM_PAGES', 2000))
+
+# Bancos até esse tamanho (páginas) são convertidos para auto_vacuum na inicialização
+AUTO_VACUUM_CONVERT_MAX_PAGES = 1000
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def install(cursor):
+    """Ativa o auto_vacuum incremental em bancos novos (ou ainda pequenos)
+
+    Deve ser chamado antes de qualquer escrita: o VACUUM não roda dentro de
+    uma transação.
+    """
+    if cursor.execute('PRAGMA auto_vacuum').fetchone()[0] != 0:
+        return
+    if cursor.execute('PRAGMA page_count').fetchone()[0] <= AUTO_VACUUM_CONVERT_MAX_PAGES:
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+
+def convert_auto_vacuum():
+    """Converte um banco existente para auto_vacuum incremental (VACUUM completo)"""
+    conn = get_connection()
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    return conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+def archive_path(user_id: int, month: str) -> str:
+    return os.path.join(HISTORY_ARCHIVE_DIR, str(int(user_id)), f'{month}.ndjson.gz')
+
+def _append(path: str, records: List[Dict]):
+    """Acrescenta um membro gzip ao arquivo do mês e força a gravação em disco"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as archive:
+            for record in records:
+                archive.write(json.dumps(record, ensure_ascii=False).encode() + b'\n')
+        raw.flush()
+        os.fsync(raw.fileno())
+
+def archive_batch(user_id: int, cutoff: str, limit: int = RETENTION_BATCH_SIZE) -> int:
+    """Arquiva e remove o lote mais antigo do usuário; retorna as linhas movidas"""
+    conn = get_connection()
+    rows = conn.execute('''
+        SELECT id, message_text, groups_sent, sent_at, status FROM message_history
+        WHERE user_id = ? AND sent_at < ?
+        ORDER BY sent_at, id
+        LIMIT ?
+    ''', (user_id, cutoff, limit)).fetchall()
+    if not rows:
+        return 0
+
+    ids = [row['id'] for row in rows]
+    placeholders = ','.join('?' * len(ids))
+    deliveries: Dict[int, List[Dict]] = {}
+    for delivery in conn.execute(f'''
+        SELECT history_id, group_id, status, telegram_message_id AS message_id, error, delivered_at
+        FROM message_deliveries WHERE history_id IN ({placeholders}) ORDER BY id
+    ''', ids):
+        item = dict(delivery)
+        deliveries.setdefault(item.pop('history_id'), []).append(item)
+
+    by_month: Dict[str, List[Dict]] = {}
+    for row in rows:
+        record = dict(row)
+        record['deliveries'] = deliveries.get(row['id'], [])
+        by_month.setdefault(str(row['sent_at'])[:7], []).append(record)
+    for month, records in by_month.items():
+        _append(archive_path(user_id, month), records)
+
+    with transaction(immediate=True) as conn:
+        conn.execute(f'DELETE FROM message_deliveries WHERE history_id IN ({placeholders})', ids)
+        conn.execute(f'DELETE FROM message_history WHERE id IN ({placeholders})', ids)
+    return len(ids)
+
+def incremental_vacuum(pages: int = RETENTION_VACUUM_PAGES) -> int:
+    """Devolve até ``pages`` páginas livres ao sistema; retorna quantas restam livres"""
+    conn = get_connection()
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return conn.execute('PRAGMA freelist_count').fetchone()[0]
+    # executescript executa o pragma até o fim (execute libera uma página por passo)
+    conn.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+    return conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+def run_once(retention_days: int = HISTORY_RETENTION_DAYS) -> Optional[Dict]:
+    """Arquiva todo o histórico vencido; None se outro processo já estiver arquivando"""
+    if retention_days <= 0:
+        return {'archived': 0, 'users': 0}
+
+    os.makedirs(HISTORY_ARCHIVE_DIR, exist_ok=True)
+    with open(os.path.join(HISTORY_ARCHIVE_DIR, '.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+
+        cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)).strftime(TIMESTAMP_FORMAT)
+        # Pelo índice de user_id: inclui histórico de usuários já removidos
+        user_ids = [row[0] for row in get_connection().execute(
+            'SELECT DISTINCT user_id FROM message_history WHERE user_id IS NOT NULL ORDER BY user_id')]
+        archived = 0
+        users = 0
+        for user_id in user_ids:
+            moved = 0
+            while True:
+                count = archive_batch(user_id, cutoff)
+                if not count:
+                    break
+                moved += count
+                incremental_vacuum()
+            if moved:
+                users += 1
+                archived += moved
+                logger.info(f"Histórico do usuário {user_id}: {moved} envios arquivados")
+        return {'archived': archived, 'users': users, 'cutoff': cutoff,
+                'free_pages': incremental_vacuum()}
+
+def _months(user_id: int) -> List[str]:
+    directory = os.path.join(HISTORY_ARCHIVE_DIR, str(int(user_id)))
+    if not os.path.isdir(directory):
+        return []
+    return sorted((name[:-len('.ndjson.gz')] for name in os.listdir(directory) if name.endswith('.ndjson.gz')),
+                  reverse=True)
+
+def _read_month(user_id: int, month: str) -> Iterator[Dict]:
+    with gzip.open(archive_path(user_id, month), 'rt', encoding='utf-8') as archive:
+        for line in archive:
+            if line.strip():
+                yield json.loads(line)
+
+def search(user_id: int, query: Optional[str] = None, status: Optional[str] = None,
+           since: Optional[str] = None, until: Optional[str] = None,
+           before: Optional[Tuple[str, int]] = None, limit: int = 50) -> Tuple[List[Dict], bool]:
+    """Busca no arquivo do usuário, do mais recente ao mais antigo
+
+    ``query`` procura (sem diferenciar maiúsculas) no texto e nos grupos;
+    ``before`` é a posição (sent_at, id) da última linha da página anterior.
+    Retorna a página e se há mais resultados.
+    """
+    needle = query.casefold() if query else None
+    results: List[Dict] = []
+    for month in _months(user_id):
+        # Meses fora do intervalo pedido nem são abertos
+        if since and month < since[:7]:
+            break
+        if (until and month > until[:7]) or (before and month > before[0][:7]):
+            continue
+
+        matches = {}
+        for record in _read_month(user_id, month):
+            sent_at = str(record['sent_at'])
+            if status and record['status'] != status:
+                continue
+            if (since and sent_at < since) or (until and sent_at >= until):
+                continue
+            if before and (sent_at, record['id']) >= before:
+                continue
+            if needle and needle not in f"{record['message_text']}\n{record['groups_sent']}".casefold():
+                continue
+            matches[record['id']] = record  # cópias de um lote rearquivado têm o mesmo id
+        results.extend(sorted(matches.values(), key=lambda item: (str(item['sent_at']), item['id']), reverse=True))
+        if len(results) > limit:
+            break
+    return results[:limit], len(results) > limit
+
+class RetentionWorker:
+    """Executa ``run_once`` periodicamente no runtime assíncrono compartilhado"""
+
+    def __init__(self, interval: float = RETENTION_INTERVAL_SECONDS):
+        self.interval = interval
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Inicia o laço de retenção (idempotente); não faz nada se estiver desligada"""
+        if HISTORY_RETENTION_DAYS <= 0:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            get_runtime().submit(self._main())
+
+    async def _main(self):
+        loop = asyncio.get_running_loop()
+        logger.info(f"Retenção do histórico iniciada ({HISTORY_RETENTION_DAYS} dias)")
+        while True:
+            try:
+                await loop.run_in_executor(None, run_once)
+            except Exception as e:
+                logger.error(f"Erro ao arquivar o histórico: {e}")
+            await asyncio.sleep(self.interval)
+
+# Instância global do worker de retenção
+retention_worker = None
+
+def get_retention_worker() -> RetentionWorker:
+    """Retorna o worker de retenção do processo"""
+    global retention_worker
+
+    if retention_worker is None:
+        retention_worker = RetentionWorker()
+
+    return retention_worker
+
+def main():
+    """Função principal"""
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command == 'run':
+        result = run_once()
+        print(result if result is not None else 'Outro processo já está arquivando')
+    elif command == 'vacuum':
+        print('auto_vacuum incremental ativo' if convert_auto_vacuum() else 'Falha ao ativar o auto_vacuum')
+    else:
+        print("Uso: python retention.py [comando]")
+        print("\nComandos disponíveis:")
+        print("  run       - Arquivar agora o histórico mais antigo que HISTORY_RETENTION_DAYS")
+        print("  vacuum    - Ativar o auto_vacuum incremental (VACUUM completo, uma vez)")
+
+if __name__ == '__main__':
+    main()
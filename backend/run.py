@@ -4,12 +4,15 @@ from dotenv import load_dotenv
 # Carregar variáveis de ambiente
 load_dotenv()
 
-from app import app, init_database
+from app import app, init_database, start_background_workers
 
 if __name__ == '__main__':
     # Inicializar banco de dados
     init_database()
     
+    # Retomar broadcasts pendentes da outbox
+    start_background_workers()
+    
     # Configurações para produção
     port = int(os.getenv('PORT', 5000))
     debug = os.getenv('FLASK_ENV') == 'development'
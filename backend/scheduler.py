@@ -0,0 +1,258 @@
+"""
+Broadcasts agendados
+
+Os agendamentos ficam em ``scheduled_broadcasts``. Cada processo mantém um
+min-heap com os horários pendentes e dorme até o próximo; ao vencer, o
+agendamento é reivindicado no banco (apenas um processo vence) e entregue à
+outbox. Agendamentos que vencem no mesmo instante são espaçados para não
+chegarem todos juntos ao pipeline de envio. Após um restart os pendentes são
+recarregados do banco.
+"""
+
+import asyncio
+import calendar
+import datetime
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from async_runtime import get_runtime
+from database import get_connection, transaction
+from outbox import get_outbox_worker
+
+logger = logging.getLogger(__name__)
+
+# Intervalo entre dois agendamentos despachados em sequência (segundos)
+SCHEDULER_STAGGER_SECONDS = float(os.getenv('SCHEDULER_STAGGER_SECONDS', 2))
+# Releitura periódica do banco (agendamentos criados por outros processos)
+SCHEDULER_RELOAD_SECONDS = float(os.getenv('SCHEDULER_RELOAD_SECONDS', 60))
+# Despacho interrompido (processo caiu) é retomado após esse tempo
+SCHEDULER_CLAIM_TIMEOUT_SECONDS = int(os.getenv('SCHEDULER_CLAIM_TIMEOUT_SECONDS', 300))
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS scheduled_broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        message_text TEXT,
+        group_ids TEXT NOT NULL,
+        template_id INTEGER,
+        media_id INTEGER,
+        scheduled_at TIMESTAMP NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        job_id TEXT,
+        error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        claimed_at TIMESTAMP,
+        dispatched_at TIMESTAMP
+    )
+'''
+
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_scheduled_status_time ON scheduled_broadcasts(status, scheduled_at)',
+    'CREATE INDEX IF NOT EXISTS idx_scheduled_user_time ON scheduled_broadcasts(user_id, scheduled_at)',
+]
+
+def install(cursor):
+    """Cria a tabela de agendamentos e seus índices"""
+    cursor.execute(SCHEMA)
+    for statement in INDEXES:
+        cursor.execute(statement)
+
+def parse_schedule_time(value: str) -> datetime.datetime:
+    """Converte ISO 8601 em datetime UTC sem fuso (horário sem fuso é tratado como UTC)"""
+    moment = datetime.datetime.fromisoformat(str(value).strip())
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return moment.replace(microsecond=0)
+
+def to_timestamp(value: str) -> float:
+    """Timestamp UTC do SQLite ('AAAA-MM-DD HH:MM:SS') em segundos epoch"""
+    return calendar.timegm(time.strptime(value, TIMESTAMP_FORMAT))
+
+def create_schedule(user_id: int, message_text: Optional[str], group_ids: List, scheduled_at: datetime.datetime,
+                    template_id: Optional[int] = None, media_id: Optional[int] = None) -> int:
+    """Grava um agendamento e o coloca no heap deste processo"""
+    when = scheduled_at.strftime(TIMESTAMP_FORMAT)
+    with transaction() as conn:
+        cursor = conn.execute('''
+            INSERT INTO scheduled_broadcasts (user_id, message_text, group_ids, template_id, media_id, scheduled_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, message_text, json.dumps(group_ids), template_id, media_id, when))
+        schedule_id = cursor.lastrowid
+    get_scheduler().add(schedule_id, to_timestamp(when))
+    return schedule_id
+
+def cancel_schedule(schedule_id: int, user_id: int) -> bool:
+    """Cancela um agendamento ainda pendente do usuário"""
+    with transaction() as conn:
+        cursor = conn.execute('''
+            UPDATE scheduled_broadcasts SET status = 'cancelled'
+            WHERE id = ? AND user_id = ? AND status = 'pending'
+        ''', (schedule_id, user_id))
+    # A entrada do heap é descartada ao vencer (a reivindicação falha)
+    return cursor.rowcount > 0
+
+def claim(schedule_id: int) -> Optional[Dict]:
+    """Reivindica um agendamento vencido; None se outro processo já o pegou"""
+    with transaction(immediate=True) as conn:
+        cursor = conn.execute('''
+            UPDATE scheduled_broadcasts SET status = 'dispatching', claimed_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'pending' AND scheduled_at <= datetime('now')
+        ''', (schedule_id,))
+        if cursor.rowcount == 0:
+            return None
+        row = conn.execute('SELECT * FROM scheduled_broadcasts WHERE id = ?', (schedule_id,)).fetchone()
+    schedule = dict(row)
+    schedule['group_ids'] = json.loads(schedule['group_ids'])
+    return schedule
+
+def finish(schedule_id: int, job_id: Optional[str], error: Optional[str]):
+    """Registra o resultado do despacho"""
+    with transaction() as conn:
+        conn.execute('''
+            UPDATE scheduled_broadcasts SET status = ?, job_id = ?, error = ?, dispatched_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', ('dispatched' if error is None else 'failed', job_id, error, schedule_id))
+
+def job_exists(job_id: str) -> bool:
+    """Indica se o job do despacho chegou a ser gravado"""
+    return get_connection().execute('SELECT 1 FROM broadcast_jobs WHERE id = ?', (job_id,)).fetchone() is not None
+
+def load_pending() -> List[tuple]:
+    """(horário, id) dos agendamentos pendentes; retoma despachos interrompidos"""
+    with transaction() as conn:
+        conn.execute('''
+            UPDATE scheduled_broadcasts SET status = 'pending', claimed_at = NULL
+            WHERE status = 'dispatching' AND job_id IS NULL AND claimed_at < datetime('now', ?)
+        ''', (f'-{SCHEDULER_CLAIM_TIMEOUT_SECONDS} seconds',))
+    rows = get_connection().execute('''
+        SELECT id, scheduled_at FROM scheduled_broadcasts WHERE status = 'pending'
+    ''').fetchall()
+    return [(to_timestamp(row['scheduled_at']), row['id']) for row in rows]
+
+class Scheduler:
+    """Min-heap de agendamentos executado no runtime assíncrono compartilhado"""
+
+    def __init__(self, stagger: float = SCHEDULER_STAGGER_SECONDS):
+        self.stagger = stagger
+        self._heap: List[tuple] = []
+        self._queued = set()
+        self._dispatcher: Optional[Callable[[Dict], str]] = None
+        self._pid = None
+        self._loop = None
+        self._wakeup = None
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def set_dispatcher(self, dispatcher: Callable[[Dict], str]):
+        """Define a função que cria o broadcast de um agendamento (retorna o job_id)"""
+        self._dispatcher = dispatcher
+
+    def start(self):
+        """Inicia o laço do agendador (idempotente); recarrega os pendentes"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            get_runtime().submit(self._main())
+
+    def add(self, schedule_id: int, due: float):
+        """Inclui um agendamento no heap (thread-safe)"""
+        if self._loop and self._pid == os.getpid():
+            self._loop.call_soon_threadsafe(self._push, due, schedule_id)
+
+    def _push(self, due: float, schedule_id: int):
+        if schedule_id in self._queued:
+            return
+        self._queued.add(schedule_id)
+        heapq.heappush(self._heap, (due, schedule_id))
+        self._wakeup.set()
+
+    async def _reload(self):
+        loop = asyncio.get_running_loop()
+        for due, schedule_id in await loop.run_in_executor(None, load_pending):
+            self._push(due, schedule_id)
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        logger.info("Agendador de broadcasts iniciado")
+        next_reload = 0.0
+        while True:
+            try:
+                if time.monotonic() >= next_reload:
+                    await self._reload()
+                    next_reload = time.monotonic() + SCHEDULER_RELOAD_SECONDS
+
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    _, schedule_id = heapq.heappop(self._heap)
+                    self._queued.discard(schedule_id)
+                    asyncio.ensure_future(self._dispatch(schedule_id, self._reserve_slot(now)))
+
+                timeout = SCHEDULER_RELOAD_SECONDS
+                if self._heap:
+                    timeout = min(timeout, max(0.0, self._heap[0][0] - time.time()))
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Erro no agendador: {e}")
+                await asyncio.sleep(1)
+
+    def _reserve_slot(self, now: float) -> float:
+        """Atraso para este despacho: vencimentos simultâneos saem espaçados"""
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.stagger
+        return slot - now
+
+    async def _dispatch(self, schedule_id: int, delay: float):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        loop = asyncio.get_running_loop()
+        schedule = await loop.run_in_executor(None, claim, schedule_id)
+        if schedule is None:
+            return  # Cancelado ou despachado por outro processo
+
+        await loop.run_in_executor(None, self._run_dispatcher, schedule)
+
+    def _run_dispatcher(self, schedule: Dict):
+        # Job criado e agendamento concluído na mesma transação: um restart no meio
+        # não gera envio duplicado
+        job_id = None
+        try:
+            with transaction(immediate=True):
+                job_id = self._dispatcher(schedule)
+                finish(schedule['id'], job_id, None)
+        except Exception as e:
+            logger.error(f"Erro ao despachar o agendamento {schedule['id']}: {e}")
+            if job_id is not None and job_exists(job_id):
+                # O job já foi gravado e será enviado: o agendamento não falhou
+                finish(schedule['id'], job_id, None)
+            else:
+                finish(schedule['id'], None, str(e))
+                return
+        get_outbox_worker().wake()
+        logger.info(f"Agendamento {schedule['id']} despachado como job {job_id}")
+
+# Instância global do agendador
+scheduler = None
+
+def get_scheduler() -> Scheduler:
+    """Retorna o agendador do processo"""
+    global scheduler
+
+    if scheduler is None:
+        scheduler = Scheduler()
+
+    return scheduler
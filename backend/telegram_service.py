@@ -4,19 +4,119 @@ Serviço para integração com o Telegram Bot
 
 import asyncio
 import logging
-from typing import List, Dict, Optional
+import time
+from typing import Callable, List, Dict, Optional
 from telegram import Bot
-from telegram.error import TelegramError
+from telegram.error import RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+import metrics
+from async_runtime import get_runtime
+from media import MediaUploads
+from rate_limiter import RateLimiter, retry_after_seconds
 import os
 
 logger = logging.getLogger(__name__)
 
+# Limite de envios simultâneos do processo (compartilhado entre broadcasts)
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 20))
+# Tentativas extras após um RetryAfter (429) do Telegram
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', 3))
+# Pausa do chat quando o RetryAfter não informa o tempo de espera (segundos)
+DEFAULT_RETRY_AFTER_SECONDS = 5.0
+# URL da Bot API (servidor local da Bot API ou o servidor falso dos benchmarks)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+
 class TelegramService:
     """Serviço para gerenciar o bot do Telegram"""
     
-    def __init__(self, token: str):
+    def __init__(self, token: str, max_concurrency: int = BROADCAST_CONCURRENCY,
+                 base_url: str = TELEGRAM_API_URL, rate_limiter: Optional[RateLimiter] = None):
         self.token = token
-        self.bot = Bot(token=token) if token else None
+        self.max_concurrency = max(1, max_concurrency)
+        # O pool HTTP precisa comportar todos os envios simultâneos
+        self.bot = Bot(
+            token=token,
+            base_url=base_url,
+            request=HTTPXRequest(connection_pool_size=self.max_concurrency, pool_timeout=30.0)
+        ) if token else None
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.media_uploads = MediaUploads()
+        self._initialized = False
+        self._semaphore = None
+        self._semaphore_loop = None
+    
+    async def initialize(self):
+        """Inicializa o bot uma única vez no loop compartilhado"""
+        if self._initialized or not self.bot:
+            return
+        self._initialized = True
+        try:
+            await self.bot.initialize()
+        except Exception as e:
+            # Falhas aparecem nos envios; não impedem o uso do cliente HTTP
+            logger.warning(f"Não foi possível inicializar o bot: {e}")
+    
+    def _send_slots(self) -> asyncio.Semaphore:
+        """Semáforo único do serviço, criado no loop em que é usado
+
+        Todos os laços da outbox compartilham o mesmo limite, que é também o
+        tamanho do pool HTTP. A vaga só é ocupada durante a chamada à Bot API.
+        """
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+    
+    async def send_text(self, chat_id: str, text: str):
+        """Envia texto respeitando os limites de taxa; repete após RetryAfter"""
+        return await self._send(chat_id, 'sendMessage', lambda: self.bot.send_message(chat_id=chat_id, text=text))
+    
+    async def send_media(self, chat_id: str, media_type: str, media, caption: Optional[str] = None):
+        """Envia foto, vídeo ou documento
+        
+        ``media`` é um file_id já conhecido ou uma função que abre o arquivo
+        (chamada a cada tentativa, já que o upload consome o arquivo).
+        """
+        name, method = {
+            'photo': ('sendPhoto', self.bot.send_photo),
+            'video': ('sendVideo', self.bot.send_video),
+            'document': ('sendDocument', self.bot.send_document),
+        }[media_type]
+        return await self._send(chat_id, name, lambda: method(
+            chat_id, media() if callable(media) else media, caption=caption or None))
+    
+    async def _send(self, chat_id: str, method: str, call: Callable):
+        attempt = 0
+        while True:
+            # Chat pausado ou no limite espera sem ocupar uma vaga de envio
+            await self.rate_limiter.wait_chat(chat_id)
+            async with self._send_slots():
+                await self.rate_limiter.acquire(chat_id)
+                try:
+                    return await self._timed(method, call)
+                except RetryAfter as e:
+                    attempt += 1
+                    if attempt > TELEGRAM_MAX_RETRIES:
+                        raise
+                    wait = retry_after_seconds(e)
+                    if wait is None:
+                        wait = DEFAULT_RETRY_AFTER_SECONDS
+                    logger.warning(f"RetryAfter em {chat_id}: aguardando {wait}s")
+                    self.rate_limiter.pause_chat(chat_id, wait)
+    
+    async def _timed(self, method: str, call: Callable):
+        """Executa uma chamada à Bot API registrando latência, erros e envios em andamento"""
+        metrics.telegram_sends_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            return await call()
+        except Exception as e:
+            metrics.telegram_errors.inc(method, type(e).__name__)
+            raise
+        finally:
+            metrics.telegram_request_duration.observe(time.perf_counter() - started, method)
+            metrics.telegram_sends_in_flight.dec()
         
     async def send_message_to_group(self, chat_id: str, message: str) -> bool:
         """Envia mensagem para um grupo específico"""
@@ -24,36 +124,61 @@ class TelegramService:
             raise Exception("Bot não configurado - token não fornecido")
         
         try:
-            await self.bot.send_message(chat_id=chat_id, text=message)
+            await self.send_text(chat_id, message)
             logger.info(f"Mensagem enviada para {chat_id}")
             return True
         except TelegramError as e:
             logger.error(f"Erro ao enviar mensagem para {chat_id}: {e}")
             return False
     
-    async def send_message_to_groups(self, groups: List[Dict], message: str) -> Dict:
-        """Envia mensagem para múltiplos grupos"""
+    async def send_message_to_groups(self, groups: List[Dict], message: Optional[str],
+                                     on_result: Optional[Callable[[Dict, Optional[str], Optional[int]], None]] = None) -> Dict:
+        """Envia mensagem para múltiplos grupos
+        
+        Um grupo com a chave ``text`` recebe esse texto no lugar de ``message``;
+        com a chave ``media`` o envio é da mídia, com o texto como legenda.
+        ``on_result(group, error, message_id)`` é chamado após cada envio (error é None
+        em caso de sucesso; message_id é o id da mensagem no Telegram).
+        """
         if not self.bot:
             raise Exception("Bot não configurado - token não fornecido")
         
-        sent_groups = []
-        failed_groups = []
+        await self.initialize()
         
-        for group in groups:
+        async def send(group: Dict) -> Optional[str]:
+            """Envia para um grupo; retorna a mensagem de erro ou None"""
             chat_id = group['chat_id']
             group_name = group['name']
             
             try:
-                await self.bot.send_message(chat_id=chat_id, text=message)
-                sent_groups.append(group_name)
+                text = group.get('text', message)
+                if group.get('media'):
+                    sent = await self.media_uploads.send(self, chat_id, group['media'], text)
+                else:
+                    sent = await self.send_text(chat_id, text)
                 logger.info(f"Mensagem enviada para {group_name} ({chat_id})")
-                
-                # Delay entre mensagens para evitar rate limiting
-                await asyncio.sleep(1)
-                
-            except TelegramError as e:
-                failed_groups.append(f"{group_name}: {str(e)}")
+                error = None
+                message_id = getattr(sent, 'message_id', None)
+            except Exception as e:
                 logger.error(f"Erro ao enviar para {group_name} ({chat_id}): {e}")
+                error = str(e)
+                message_id = None
+            
+            metrics.broadcast_messages.inc('sent' if error is None else 'failed')
+            if on_result:
+                on_result(group, error, message_id)
+            return error
+        
+        # Fan-out concorrente; as chamadas à Bot API são limitadas pelo semáforo do serviço
+        errors = await asyncio.gather(*(send(group) for group in groups))
+        
+        sent_groups = []
+        failed_groups = []
+        for group, error in zip(groups, errors):
+            if error is None:
+                sent_groups.append(group['name'])
+            else:
+                failed_groups.append(f"{group['name']}: {error}")
         
         return {
             'sent_groups': sent_groups,
@@ -106,14 +231,5 @@ def send_message_sync(groups: List[Dict], message: str) -> Dict:
     """Versão síncrona para envio de mensagens"""
     service = get_telegram_service()
     
-    # Executar de forma síncrona
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    
-    try:
-        result = loop.run_until_complete(
-            service.send_message_to_groups(groups, message)
-        )
-        return result
-    finally:
-        loop.close()
+    # Executar no loop compartilhado, reaproveitando as conexões do bot
+    return get_runtime().run(service.send_message_to_groups(groups, message))
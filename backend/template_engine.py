@@ -0,0 +1,124 @@
+"""
+Templates de mensagem com personalização por grupo
+
+O texto aceita marcadores como ``{{group_name}}`` ou ``{{date}}``. Cada
+template é compilado uma única vez em segmentos (texto fixo e variáveis) e
+guardado em cache por (id, versão); no envio, o texto de cada grupo é apenas
+a junção dos segmentos com os valores daquele grupo.
+"""
+
+import datetime
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+# Templates compilados mantidos em memória
+TEMPLATE_CACHE_SIZE = int(os.getenv('TEMPLATE_CACHE_SIZE', 512))
+
+PLACEHOLDER_RE = re.compile(r'\{\{\s*([a-z_][a-z0-9_]*)\s*\}\}')
+
+# Variáveis disponíveis; marcadores desconhecidos permanecem como texto
+VARIABLES = {
+    'group_name': 'Nome do grupo',
+    'group_id': 'Id do grupo no sistema',
+    'chat_id': 'Chat ID do Telegram',
+    'date': 'Data do envio (dd/mm/aaaa)',
+    'time': 'Hora do envio (hh:mm)',
+    'datetime': 'Data e hora do envio',
+}
+
+class CompiledTemplate:
+    """Template já dividido em segmentos: texto fixo ou nome de variável"""
+
+    __slots__ = ('segments', 'variables', 'constant')
+
+    def __init__(self, segments: Tuple[Tuple[bool, str], ...]):
+        self.segments = segments
+        self.variables = frozenset(value for is_variable, value in segments if is_variable)
+        # Sem variáveis o texto é o mesmo para todos os grupos
+        self.constant = None if self.variables else ''.join(value for _, value in segments)
+
+    def render(self, context: Dict[str, str]) -> str:
+        """Texto final para um destinatário"""
+        if self.constant is not None:
+            return self.constant
+        return ''.join(context.get(value, '') if is_variable else value
+                       for is_variable, value in self.segments)
+
+def compile_template(source: str) -> CompiledTemplate:
+    """Divide o texto em segmentos (uma única passada pela regex)"""
+    segments = []
+    position = 0
+    for match in PLACEHOLDER_RE.finditer(source):
+        name = match.group(1)
+        if name not in VARIABLES:
+            continue
+        if match.start() > position:
+            segments.append((False, source[position:match.start()]))
+        segments.append((True, name))
+        position = match.end()
+    if position < len(source):
+        segments.append((False, source[position:]))
+    return CompiledTemplate(tuple(segments))
+
+def send_context(now: Optional[datetime.datetime] = None) -> Dict[str, str]:
+    """Variáveis comuns a todos os grupos de um lote de envio"""
+    now = now or datetime.datetime.now()
+    return {
+        'date': now.strftime('%d/%m/%Y'),
+        'time': now.strftime('%H:%M'),
+        'datetime': now.strftime('%d/%m/%Y %H:%M'),
+    }
+
+def group_context(base: Dict[str, str], group: Dict) -> Dict[str, str]:
+    """Variáveis de um destinatário"""
+    return {
+        **base,
+        'group_name': group.get('name') or '',
+        'group_id': str(group.get('id', '')),
+        'chat_id': str(group.get('chat_id', '')),
+    }
+
+class TemplateCache:
+    """LRU de templates compilados, por (id, versão) ou pelo hash do texto"""
+
+    def __init__(self, max_size: int = TEMPLATE_CACHE_SIZE):
+        self.max_size = max(1, max_size)
+        self._compiled: 'OrderedDict[Hashable, CompiledTemplate]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, source: str, template_id: Optional[int] = None,
+            version: Optional[int] = None) -> CompiledTemplate:
+        """Template compilado; compila e guarda na primeira vez"""
+        if template_id is not None:
+            key = ('template', template_id, version)
+        else:
+            key = ('text', hashlib.sha1(source.encode()).hexdigest())
+
+        with self._lock:
+            compiled = self._compiled.get(key)
+            if compiled is not None:
+                self._compiled.move_to_end(key)
+                return compiled
+
+        compiled = compile_template(source)
+        with self._lock:
+            self._compiled[key] = compiled
+            while len(self._compiled) > self.max_size:
+                self._compiled.popitem(last=False)
+        return compiled
+
+# Instância global do cache
+template_cache = None
+
+def get_template_cache() -> TemplateCache:
+    """Retorna o cache de templates compilados do processo"""
+    global template_cache
+
+    if template_cache is None:
+        template_cache = TemplateCache()
+
+    return template_cache
@@ -0,0 +1,130 @@
+"""
+Cache de tokens JWT já verificados
+
+Guarda as claims de cada token válido (chave: sha256 do token) até o seu
+``exp``, em um LRU limitado, e um registro curto de identidade por usuário
+usado por /api/me. Com isso a autenticação de clientes que fazem muitas
+requisições vira uma busca em dicionário.
+
+O cache é por processo: revogações valem para o processo que as recebeu e as
+entradas dos demais expiram pelo ``exp`` do token ou pelo TTL da identidade.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+# Tokens verificados mantidos em memória
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 10000))
+# Validade do registro de identidade em cache (segundos)
+IDENTITY_CACHE_TTL = float(os.getenv('IDENTITY_CACHE_TTL', 300))
+# Vida máxima de um token emitido por generate_token (segundos)
+TOKEN_MAX_AGE = 24 * 3600
+
+def token_digest(token: str) -> str:
+    """Chave do cache: o token em si nunca é guardado"""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+class TokenCache:
+    """LRU de claims verificadas + identidades por usuário"""
+
+    def __init__(self, max_size: int = TOKEN_CACHE_SIZE, identity_ttl: float = IDENTITY_CACHE_TTL):
+        self.max_size = max(1, max_size)
+        self.identity_ttl = identity_ttl
+        self._tokens: 'OrderedDict[str, Dict]' = OrderedDict()
+        self._identities: Dict[int, tuple] = {}
+        # Tokens revogados (digest -> exp) e usuários revogados (id -> momento)
+        self._revoked_tokens: Dict[str, float] = {}
+        self._revoked_users: Dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[Dict]:
+        """Claims do token se já verificado e ainda válido"""
+        key = token_digest(token)
+        now = time.time()
+        with self._lock:
+            payload = self._tokens.get(key)
+            if payload is None:
+                return None
+            if payload.get('exp', 0) <= now:
+                del self._tokens[key]
+                return None
+            self._tokens.move_to_end(key)
+            return payload
+
+    def put(self, token: str, payload: Dict):
+        """Guarda as claims de um token recém-verificado"""
+        key = token_digest(token)
+        with self._lock:
+            self._tokens[key] = payload
+            self._tokens.move_to_end(key)
+            while len(self._tokens) > self.max_size:
+                self._tokens.popitem(last=False)
+
+    def is_revoked(self, token: str, payload: Dict) -> bool:
+        """Token revogado individualmente ou emitido antes da revogação do usuário"""
+        now = time.time()
+        with self._lock:
+            self._purge_revoked(now)
+            if token_digest(token) in self._revoked_tokens:
+                return True
+            revoked_at = self._revoked_users.get(payload.get('sub'))
+            return revoked_at is not None and payload.get('iat', 0) <= revoked_at
+
+    def revoke_token(self, token: str, expires_at: float):
+        """Invalida um único token até o seu exp"""
+        key = token_digest(token)
+        with self._lock:
+            self._tokens.pop(key, None)
+            self._revoked_tokens[key] = expires_at
+
+    def revoke_user(self, user_id: int):
+        """Invalida todos os tokens já emitidos para o usuário e sua identidade"""
+        with self._lock:
+            self._revoked_users[user_id] = time.time()
+            for key in [key for key, payload in self._tokens.items() if payload.get('sub') == user_id]:
+                del self._tokens[key]
+            self._identities.pop(user_id, None)
+
+    def get_identity(self, user_id: int, loader: Callable[[int], Optional[Dict]]) -> Optional[Dict]:
+        """Registro do usuário (id, nome, email...), carregado por ``loader`` se preciso"""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._identities.get(user_id)
+            if cached and cached[0] > now:
+                return cached[1]
+
+        identity = loader(user_id)
+        if identity is not None:
+            with self._lock:
+                if len(self._identities) >= self.max_size:
+                    self._identities.clear()
+                self._identities[user_id] = (now + self.identity_ttl, identity)
+        return identity
+
+    def invalidate_identity(self, user_id: int):
+        """Descarta a identidade em cache (ex.: após atualizar o perfil)"""
+        with self._lock:
+            self._identities.pop(user_id, None)
+
+    def _purge_revoked(self, now: float):
+        # Tokens revogados deixam a lista quando expiram; usuários, após a vida máxima de um token
+        for key in [key for key, exp in self._revoked_tokens.items() if exp <= now]:
+            del self._revoked_tokens[key]
+        for user_id in [user_id for user_id, at in self._revoked_users.items() if at + TOKEN_MAX_AGE <= now]:
+            del self._revoked_users[user_id]
+
+# Instância global do cache
+token_cache = None
+
+def get_token_cache() -> TokenCache:
+    """Retorna o cache de tokens do processo"""
+    global token_cache
+
+    if token_cache is None:
+        token_cache = TokenCache()
+
+    return token_cache
@@ -4,6 +4,51 @@ class ApiClient {
   constructor() {
     this.baseUrl = API_CONFIG.BASE_URL
     this.timeout = API_CONFIG.TIMEOUT
+    // Última resposta de cada listagem com ETag: endpoint -> { etag, data }
+    this.etagCache = new Map()
+  }
+
+  // GET condicional: envia If-None-Match e reaproveita os dados em caso de 304
+  async cachedRequest(endpoint) {
+    const cached = this.etagCache.get(endpoint)
+    const headers = getAuthHeaders()
+    if (cached) {
+      headers["If-None-Match"] = cached.etag
+    }
+
+    const controller = new AbortController()
+    const timeoutId = setTimeout(() => controller.abort(), this.timeout)
+
+    try {
+      const response = await fetch(`${this.baseUrl}${endpoint}`, {
+        headers,
+        cache: "no-store",
+        signal: controller.signal,
+      })
+
+      if (response.status === 304 && cached) {
+        return cached.data
+      }
+
+      if (!response.ok) {
+        const errorData = await response.json().catch(() => ({}))
+        throw new Error(errorData.error || `HTTP ${response.status}`)
+      }
+
+      const data = await response.json()
+      const etag = response.headers.get("ETag")
+      if (etag) {
+        this.etagCache.set(endpoint, { etag, data })
+      }
+      return data
+    } catch (error) {
+      if (error.name === "AbortError") {
+        throw new Error("Timeout: A requisição demorou muito para responder")
+      }
+      throw error
+    } finally {
+      clearTimeout(timeoutId)
+    }
   }
 
   async request(endpoint, options = {}) {
@@ -82,7 +127,7 @@ class ApiClient {
 
   // Grupos
   async getGroups() {
-    return this.request("/groups")
+    return this.cachedRequest("/groups")
   }
 
   async addGroup(chatId, name) {
@@ -92,9 +137,17 @@ class ApiClient {
     })
   }
 
+  // Importação em lote: lista de { chat_id, name, active }
+  async importGroups(groups) {
+    return this.request("/groups/import", {
+      method: "POST",
+      body: JSON.stringify({ groups }),
+    })
+  }
+
   // Templates
   async getTemplates() {
-    return this.request("/templates")
+    return this.cachedRequest("/templates")
   }
 
   async createTemplate(name, content) {
@@ -111,16 +164,35 @@ class ApiClient {
   }
 
   // Mensagens
-  async sendMessage(message, groups) {
+  async sendMessage(message, groups, mediaId = null) {
+    const body = { message, groups }
+    if (mediaId) {
+      body.media_id = mediaId
+    }
     return this.request("/send_message", {
       method: "POST",
-      body: JSON.stringify({ message, groups }),
+      body: JSON.stringify(body),
+    })
+  }
+
+  // Mídias: o upload é multipart, sem o Content-Type JSON padrão
+  async uploadMedia(file, type = null) {
+    const form = new FormData()
+    form.append("file", file)
+    if (type) {
+      form.append("type", type)
+    }
+    const { "Content-Type": _, ...headers } = getAuthHeaders()
+    return this.request("/media", {
+      method: "POST",
+      headers,
+      body: form,
     })
   }
 
   // Histórico
   async getHistory() {
-    return this.request("/history")
+    return this.cachedRequest("/history")
   }
 }
 